@@ -1,12 +1,18 @@
 import json
 import os
+import time
 
-from functools import lru_cache
-from pathlib import Path
+from collections import OrderedDict
+from weakref import WeakKeyDictionary
 from typing import (
     TYPE_CHECKING,
+    Any,
+    Callable,
     Dict,
+    FrozenSet,
+    List,
     Mapping,
+    NamedTuple,
     Optional,
     Tuple,
     Union,
@@ -21,13 +27,21 @@ from qgis.core import (
 )
 from qgis.server import QgsRequestHandler, QgsServerResponse
 
-from .tools import to_bool
+from .tools import env_float, to_bool, _N
 
 from . import logger
 
 if TYPE_CHECKING:
     from qgis.core import QgsVectorLayer
 
+CONFIG_CACHE_MAX_SIZE = 100
+# Number of distinct group combinations to keep for each config
+VISIBLE_LAYERS_CACHE_MAX_SIZE = 1000
+
+# Number of seconds to keep a Lizmap config without checking the file
+# By default, the file is checked once per request
+CONFIG_CACHE_TTL_KEY = "QGIS_SERVER_LIZMAP_CONFIG_CACHE_TTL"
+
 
 def write_json_response(
     data: Mapping[str, object],
@@ -47,29 +61,77 @@ def find_vector_layer_from_params(params: dict, project: QgsProject) -> Optional
     return find_vector_layer(layer_name, project) if layer_name else None
 
 
+class ProjectLayerIndex:
+    """Layers of a project indexed by name, short name and layer ID.
+
+    The index is rebuilt when layers are added, removed or renamed.
+    """
+
+    def __init__(self, project: QgsProject):
+        self._layers: Optional[Dict[str, QgsMapLayer]] = None
+        self._count = 0
+        # Layers already connected to the index
+        self._connected: set = set()
+        project.layersAdded.connect(self.invalidate)
+        project.layersRemoved.connect(self._layers_removed)
+        project.cleared.connect(self._cleared)
+
+    def invalidate(self, *args):
+        """The index must be rebuilt for the next lookup."""
+        _ = args
+        self._layers = None
+
+    def _layers_removed(self, layer_ids: List[str]):
+        self._connected.difference_update(layer_ids)
+        self.invalidate()
+
+    def _cleared(self):
+        self._connected.clear()
+        self.invalidate()
+
+    def find(self, layer_name: str, project: QgsProject) -> Optional[QgsMapLayer]:
+        """Find layer with name, short name or layer ID."""
+        if self._layers is None or self._count != project.count():
+            self._build(project)
+        return cast("Dict[str, QgsMapLayer]", self._layers).get(layer_name)
+
+    def _build(self, project: QgsProject):
+        layers: Dict[str, QgsMapLayer] = {}
+        for layer in project.mapLayers().values():
+            # The first layer matching the name, the short name or the layer ID wins
+            for key in (layer.name(), _layer_short_name(layer), layer.id()):
+                layers.setdefault(key, layer)
+
+            if layer.id() not in self._connected:
+                layer.nameChanged.connect(self.invalidate)
+                self._connected.add(layer.id())
+
+        self._layers = layers
+        self._count = project.count()
+
+
+_layer_indexes: "WeakKeyDictionary[QgsProject, ProjectLayerIndex]" = WeakKeyDictionary()
+
+
+def _layer_short_name(layer: QgsMapLayer) -> str:
+    """Layer short name."""
+    if Qgis.versionInt() < 33800:
+        return layer.shortName()
+    return _N(layer.serverProperties()).shortName()
+
+
+def project_layer_index(project: QgsProject) -> ProjectLayerIndex:
+    """The index of the layers of the project, created once by project."""
+    index = _layer_indexes.get(project)
+    if index is None:
+        index = ProjectLayerIndex(project)
+        _layer_indexes[project] = index
+    return index
+
+
 def find_layer(layer_name: str, project: QgsProject) -> Optional[QgsMapLayer]:
     """Find layer with name, short name or layer ID."""
-    found: Optional[QgsMapLayer] = None
-    for layer in project.mapLayers().values():
-        # check name
-        if layer.name() == layer_name:
-            found = layer
-            break
-
-        # check short name
-        if Qgis.versionInt() < 33800:
-            if layer.shortName() == layer_name:
-                found = layer
-        elif layer.serverProperties().shortName() == layer_name:
-            found = layer
-
-        if found:
-            break
-
-        # check layer id
-        if layer.id() == layer_name:
-            found = layer
-            break
+    found = project_layer_index(project).find(layer_name, project)
 
     if not found:
         logger.warning(f"The layer '{layer_name}' has not been found in the project '{project.fileName()}'")
@@ -98,32 +160,17 @@ def get_server_fid(feature: QgsFeature, pk_attributes: list) -> str:
 
 def get_lizmap_config(qgis_project_path: str) -> Optional[dict]:
     """Get the lizmap config based on QGIS project path"""
+    config = get_lizmap_config_view(qgis_project_path)
+    return config.cfg if config else None
 
-    # Check QGIS project path
-    if not os.path.exists(qgis_project_path):
-        # QGIS Project path does not exist as a file
-        # No Lizmap config
-        return None
-
-    # Get Lizmap config path
-    config_path = qgis_project_path + ".cfg"
-    if not os.path.exists(config_path):
-        # Lizmap config path does not exist
-        logger.info("Lizmap config does not exist")
-        # No Lizmap config
-        return None
-
-    last_modified = Path(config_path).stat().st_mtime
-    logger.info(f"Fetching {config_path} cfg file with last modified timestamp : {last_modified}")
-    return _get_lizmap_config(config_path, last_modified)
 
+def get_lizmap_config_view(qgis_project_path: str) -> Optional["LizmapConfigView"]:
+    """Get the indexed lizmap config based on QGIS project path"""
+    return _config_cache.get(qgis_project_path)
 
-@lru_cache(maxsize=100)
-def _get_lizmap_config(config_path: str, last_modified: float) -> Optional[dict]:
-    """Get the lizmap config based on QGIS project path with cache."""
-    # Last modified is only for LRU cache
-    _ = last_modified
 
+def _get_lizmap_config(config_path: str) -> Optional[dict]:
+    """Read the lizmap config file."""
     # Get Lizmap config
     with open(config_path) as cfg_file:
         # noinspection PyBroadException
@@ -207,6 +254,217 @@ def get_lizmap_layer_login_filter(config: Dict, layer_name: str) -> Union[Dict,
     return cfg_layer_login_filter
 
 
+def _clean_groups(value: Any, layer: str, option: str) -> FrozenSet[str]:
+    """Group names of a config option, a list or a string separated by comma.
+
+    The malformed names are skipped, so a malformed option matches no group.
+    """
+    if isinstance(value, str):
+        values = value.split(",")
+    elif isinstance(value, (list, tuple)):
+        values = value
+    else:
+        values = ()
+    groups = frozenset(g.strip() for g in values if isinstance(g, str))
+    if not values or not all(isinstance(g, str) for g in values):
+        logger.warning(f"The option '{option}' of the layer '{layer}' is malformed in the Lizmap config")
+    return groups
+
+
+class LizmapConfigView:
+    """Lizmap config indexed once when the file is loaded.
+
+    The raw config is still available with the `cfg` attribute.
+    """
+
+    def __init__(self, cfg: dict, last_modified: float):
+        self.cfg = cfg
+        self.last_modified = last_modified
+
+        self.options: dict = cfg.get("options") or {}
+
+        # Layers by name and by ID
+        self.layers: Dict[str, dict] = get_lizmap_layers_config(cfg) or {}
+        self.layers_by_id: Dict[str, dict] = {}
+        for layer_name, cfg_layer in self.layers.items():
+            if not isinstance(cfg_layer, dict) or not cfg_layer.get("id"):
+                continue
+            if not isinstance(cfg_layer["id"], str):
+                logger.warning(f"The layer '{layer_name}' has an invalid ID in the Lizmap config")
+                continue
+            self.layers_by_id[cfg_layer["id"]] = cfg_layer
+
+        # Edition layers by layer ID
+        edition_layers = cfg.get("editionLayers")
+        self.edition_layers: Dict[str, dict] = edition_layers if isinstance(edition_layers, dict) else {}
+
+        # Well formed login filters by layer name
+        self.login_filters: Dict[str, dict] = {}
+        login_filtered_layers = cfg.get("loginFilteredLayers")
+        if isinstance(login_filtered_layers, dict):
+            for layer_name in login_filtered_layers:
+                cfg_layer_login_filter = get_lizmap_layer_login_filter(cfg, layer_name)
+                if cfg_layer_login_filter:
+                    self.login_filters[layer_name] = cfg_layer_login_filter
+
+        # Cleaned edition ACL by layer ID, only for layers having one
+        self.edition_acl: Dict[str, FrozenSet[str]] = {}
+        for layer_id, edit_layer in self.edition_layers.items():
+            if isinstance(edit_layer, dict) and edit_layer.get("acl"):
+                self.edition_acl[layer_id] = _clean_groups(edit_layer["acl"], layer_id, "acl")
+
+        # Cleaned group visibility by layer name, only for layers having one
+        self.group_visibility: Dict[str, FrozenSet[str]] = {}
+        for layer_name, cfg_layer in self.layers.items():
+            if isinstance(cfg_layer, dict) and cfg_layer.get("group_visibility"):
+                self.group_visibility[layer_name] = _clean_groups(
+                    cfg_layer["group_visibility"], layer_name, "group_visibility"
+                )
+        self.max_group_visibility_size = max((len(v) for v in self.group_visibility.values()), default=0)
+
+        # Reverse index, layer names by group in the group visibility
+        visible_layers: Dict[str, set] = {}
+        for layer_name, group_visibility in self.group_visibility.items():
+            for group in group_visibility:
+                visible_layers.setdefault(group, set()).add(layer_name)
+        self.visible_layers_by_group: Dict[str, FrozenSet[str]] = {
+            group: frozenset(layer_names) for group, layer_names in visible_layers.items()
+        }
+        self._visible_layers: Dict[Tuple[str, ...], FrozenSet[str]] = {}
+
+        # Layer names having a popup from the drag and drop form
+        self.form_popup_layers: FrozenSet[str] = frozenset(
+            layer_name
+            for layer_name, cfg_layer in self.layers.items()
+            if isinstance(cfg_layer, dict)
+            and to_bool(cfg_layer.get("popup"))
+            and cfg_layer.get("popupSource") == "form"
+        )
+
+    def login_filter(self, layer_name: str) -> Optional[dict]:
+        """Get loginFilteredLayers for layer"""
+        return self.login_filters.get(layer_name)
+
+    def visible_layers(self, groups: Tuple[str, ...]) -> FrozenSet[str]:
+        """Layer names having one of the groups in their group visibility."""
+        layer_names = self._visible_layers.get(groups)
+        if layer_names is None:
+            layer_names = frozenset().union(*(self.visible_layers_by_group.get(g, ()) for g in groups))
+            if len(self._visible_layers) >= VISIBLE_LAYERS_CACHE_MAX_SIZE:
+                self._visible_layers.clear()
+            self._visible_layers[groups] = layer_names
+        return layer_names
+
+
+class _ConfigCacheEntry(NamedTuple):
+    # Request generation when the files have been checked
+    generation: int
+    # Monotonic time when the files have been checked
+    checked: float
+    # Last modified time of the config file, None if it does not exist
+    last_modified: Optional[float]
+    config: Optional[LizmapConfigView]
+
+
+class LizmapConfigCache:
+    """Cache of the indexed Lizmap configs.
+
+    The files are checked at most once per request, or once per `ttl` seconds
+    if a TTL has been set with the environment variable.
+    """
+
+    def __init__(self, max_size: int = CONFIG_CACHE_MAX_SIZE, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = config_cache_ttl() if ttl is None else ttl
+        self._generation = 0
+        self._entries: OrderedDict[str, _ConfigCacheEntry] = OrderedDict()
+
+    def new_request(self):
+        """Invalidate the checks done during the previous request."""
+        self._generation += 1
+
+    def clear(self):
+        """Remove all configs from the cache."""
+        self._entries.clear()
+
+    def get(self, qgis_project_path: str) -> Optional[LizmapConfigView]:
+        """Get the indexed config for the QGIS project path."""
+        now = time.monotonic()
+        entry = self._entries.get(qgis_project_path)
+        if entry is not None and (
+            entry.generation == self._generation or (self.ttl > 0 and now - entry.checked < self.ttl)
+        ):
+            self._entries.move_to_end(qgis_project_path)
+            return entry.config
+
+        last_modified = self._last_modified(qgis_project_path)
+        if last_modified is None:
+            config = None
+        elif entry is not None and entry.last_modified == last_modified:
+            # The file has not been modified since the previous check
+            config = entry.config
+        else:
+            config_path = qgis_project_path + ".cfg"
+            logger.info(f"Fetching {config_path} cfg file with last modified timestamp : {last_modified}")
+            cfg = _get_lizmap_config(config_path)
+            config = LizmapConfigView(cfg, last_modified) if cfg else None
+
+        self._entries[qgis_project_path] = _ConfigCacheEntry(self._generation, now, last_modified, config)
+        self._entries.move_to_end(qgis_project_path)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+        return config
+
+    @staticmethod
+    def _last_modified(qgis_project_path: str) -> Optional[float]:
+        """Last modified time of the Lizmap config, None if there is no config."""
+        # Check QGIS project path
+        if not os.path.exists(qgis_project_path):
+            # QGIS Project path does not exist as a file
+            # No Lizmap config
+            return None
+
+        # Get Lizmap config path
+        try:
+            return os.stat(qgis_project_path + ".cfg").st_mtime
+        except OSError:
+            # Lizmap config path does not exist
+            logger.info("Lizmap config does not exist")
+            # No Lizmap config
+            return None
+
+
+def config_cache_ttl() -> float:
+    """Number of seconds a Lizmap config is kept without checking the file again."""
+    return max(env_float(CONFIG_CACHE_TTL_KEY, 0), 0)
+
+
+_config_cache = LizmapConfigCache()
+
+#
+# Request scoped caches
+#
+# Caches valid only for the current request register a callback,
+# called by the Lizmap filter at the beginning of each request.
+#
+_request_cache_callbacks: List[Callable[[], None]] = []
+
+
+def register_request_cache(clear: Callable[[], None]):
+    """Register a callback clearing a request scoped cache."""
+    _request_cache_callbacks.append(clear)
+
+
+def clear_request_caches():
+    """Clear all request scoped caches."""
+    for clear in _request_cache_callbacks:
+        clear()
+
+
+register_request_cache(_config_cache.new_request)
+
+
 def get_lizmap_groups(handler: QgsRequestHandler) -> Tuple[str, ...]:
     """Get Lizmap user groups provided by the request"""
 
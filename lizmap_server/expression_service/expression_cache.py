@@ -0,0 +1,59 @@
+import math
+
+from typing import (
+    FrozenSet,
+    NamedTuple,
+)
+
+from qgis.core import (
+    QgsExpression,
+    QgsProject,
+    QgsVectorLayer,
+)
+
+from ..tools import TTLCache
+
+"""
+Expressions of the expression service, parsed once for many requests.
+"""
+
+EXPRESSION_CACHE_MAX_SIZE = 500
+
+
+class ParsedExpression(NamedTuple):
+    """An expression parsed once, with its parser error and what it references."""
+
+    expression: QgsExpression
+    referenced_columns: FrozenSet[str]
+    referenced_functions: FrozenSet[str]
+
+    def copy(self) -> QgsExpression:
+        """A copy of the expression, to set up and prepare for the request."""
+        return QgsExpression(self.expression)
+
+
+# Parsed expressions by (expression, layer ID, project, project last modified), they never expire
+_expression_cache = TTLCache(EXPRESSION_CACHE_MAX_SIZE, math.inf)
+
+
+def parsed_expression(expression: str, layer: QgsVectorLayer, project: QgsProject) -> ParsedExpression:
+    """The expression parsed once by layer and project.
+
+    The project is reloaded by QGIS Server when its file is modified, so are the layers.
+    """
+    key = (
+        expression,
+        layer.id(),
+        project.fileName(),
+        project.lastModified().toMSecsSinceEpoch(),
+    )
+    parsed = _expression_cache.get(key)
+    if parsed is None:
+        exp = QgsExpression(expression)
+        parsed = ParsedExpression(
+            expression=exp,
+            referenced_columns=frozenset(exp.referencedColumns()),
+            referenced_functions=frozenset(exp.referencedFunctions()),
+        )
+        _expression_cache.set(key, parsed)
+    return parsed
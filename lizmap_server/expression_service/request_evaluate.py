@@ -30,6 +30,7 @@ from lizmap_server.core import (
     write_json_response,
 )
 from ..exception import ExpressionServiceError
+from .expression_cache import parsed_expression
 from ..qgis4_compat import (
     QgsJsonUtils_stringToFields,
     QgsJsonUtils_stringToFeatureList,
@@ -124,7 +125,7 @@ def evaluate(params: Dict[str, str], response: QgsServerResponse, project: QgsPr
         exp_items = ()
 
     for k, e in exp_items:
-        exp = QgsExpression(e)
+        exp = parsed_expression(e, layer, project).copy()
         exp.setGeomCalculator(da)
         exp.setDistanceUnits(project.distanceUnits())
         exp.setAreaUnits(project.areaUnits())
@@ -10,7 +10,6 @@ from typing import (
 
 from qgis.core import (
     QgsDistanceArea,
-    QgsExpression,
     QgsExpressionContext,
     QgsExpressionContextUtils,
     QgsFeatureRequest,
@@ -26,6 +25,7 @@ from lizmap_server.core import (
     get_server_fid,
 )
 from ..exception import ExpressionServiceError
+from .expression_cache import parsed_expression
 from ..qgis4_compat import (
     QgsJsonUtils_stringToFields,
     QgsJsonUtils_stringToFeatureList,
@@ -209,7 +209,7 @@ def get_feature_with_form_scope(
     da.setEllipsoid(project.ellipsoid())
 
     # Get filter expression
-    exp_f = QgsExpression(exp_filter)
+    exp_f = parsed_expression(exp_filter, layer, project).copy()
     exp_f.setGeomCalculator(da)
     exp_f.setDistanceUnits(project.distanceUnits())
     exp_f.setAreaUnits(project.areaUnits())
@@ -16,7 +16,6 @@ from typing import (
 from qgis.core import (
     Qgis,
     QgsDistanceArea,
-    QgsExpression,
     QgsExpressionContext,
     QgsExpressionContextUtils,
     QgsFeature,
@@ -37,6 +36,7 @@ from lizmap_server.core import (
     write_json_response,
 )
 from ..exception import ExpressionServiceError
+from ..expression_template import expression_template
 from ..qgis4_compat import (
     QgsJsonUtils_stringToFields,
     QgsJsonUtils_stringToFeatureList,
@@ -159,7 +159,9 @@ def replace_expression_text(
     if not features:
         result = {}
         for k, s in str_map.items():
-            value = QgsExpression.replaceExpressionText(f"{s}", exp_context, da)
+            template = expression_template(f"{s}")
+            template.prepare(exp_context, da)
+            value = template.render(exp_context)
             result[k] = json.loads(QgsJsonUtils.encodeValue(value))
         body["results"].append(result)
         write_json_response(body, response)
@@ -253,6 +255,10 @@ def replace_expression_text(
     else:
         exporter = None
 
+    # parse the strings once, the expressions are prepared with the first feature
+    templates = {k: expression_template(f"{s}") for k, s in str_map.items()}
+    prepared = False
+
     # loop through provided features to replace expression strings
     for f in feature_list:  # ty: ignore[not-iterable]
         # clone the features with all attributes
@@ -271,10 +277,15 @@ def replace_expression_text(
         exp_context.setFeature(feature)
         exp_context.setFields(feature.fields())
 
+        if not prepared:
+            for template in templates.values():
+                template.prepare(exp_context, da)
+            prepared = True
+
         # replace expression strings with the new feature
         result = {}
-        for k, s in str_map.items():
-            value = QgsExpression.replaceExpressionText(f"{s}", exp_context, da)
+        for k, template in templates.items():
+            value = template.render(exp_context)
             result[k] = json.loads(QgsJsonUtils.encodeValue(value))
         if exporter:
             feature = QgsFeature(geojson_fields, f.id())
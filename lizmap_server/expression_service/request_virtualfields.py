@@ -19,6 +19,7 @@ from qgis.core import (
     QgsJsonExporter,
     QgsJsonUtils,
     QgsProject,
+    QgsVectorLayer,
 )
 from qgis.server import (
     QgsServerInterface,
@@ -33,6 +34,7 @@ from ..exception import ExpressionServiceError
 from ..tools import to_bool, _N
 from .. import logger
 
+from .expression_cache import parsed_expression
 from .models import (
     ALLOWED_SAFE_EXPRESSIONS,
     NOT_ALLOWED_EXPRESSION,
@@ -101,7 +103,7 @@ def virtual_fields(
     exp_map = {}
     exp_parser_errors = []
     for field, expression in vir_json.items():
-        exp, error = check_expression(expression, distance_area, project)
+        exp, error = check_expression(expression, distance_area, project, layer)
         if error:
             exp_parser_errors.append(error)
             continue
@@ -112,14 +114,14 @@ def virtual_fields(
         exp_map[field] = exp
 
     for field, expression in safe_vir_json.items():
-        exp, error = check_expression(expression, distance_area, project)
+        exp, error = check_expression(expression, distance_area, project, layer)
         if error:
             exp_parser_errors.append(error)
             continue
 
         exp = _N(exp)
 
-        for member in exp.referencedFunctions():
+        for member in parsed_expression(expression, layer, project).referenced_functions:
             if member not in ALLOWED_SAFE_EXPRESSIONS:
                 allowed = ",".join(ALLOWED_SAFE_EXPRESSIONS)
                 logger.warning(
@@ -147,7 +149,7 @@ def virtual_fields(
     # get filter
     req_filter = params.get("FILTER", "")
     if req_filter:
-        req_exp = QgsExpression(req_filter)
+        req_exp = parsed_expression(req_filter, layer, project).copy()
         req_exp.setGeomCalculator(distance_area)
         req_exp.setDistanceUnits(project.distanceUnits())
         req_exp.setAreaUnits(project.areaUnits())
@@ -281,9 +283,16 @@ def check_expression(
     expression_str: str,
     distance_area: QgsDistanceArea,
     project: QgsProject,
+    layer: Optional[QgsVectorLayer] = None,
 ) -> Tuple[Optional[QgsExpression], str]:
-    """Check if an expression as a string has an error or not."""
-    expression = QgsExpression(expression_str)
+    """Check if an expression as a string has an error or not.
+
+    The expression is parsed once if the layer is given.
+    """
+    if layer is not None:
+        expression = parsed_expression(expression_str, layer, project).copy()
+    else:
+        expression = QgsExpression(expression_str)
     expression.setGeomCalculator(distance_area)
     expression.setDistanceUnits(project.distanceUnits())
     expression.setAreaUnits(project.areaUnits())
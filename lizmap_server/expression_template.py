@@ -0,0 +1,130 @@
+import math
+import re
+
+from typing import (
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+from qgis.core import (
+    QgsDistanceArea,
+    QgsExpression,
+    QgsExpressionContext,
+)
+from qgis.PyQt.QtCore import QVariant
+
+from .tools import TTLCache
+
+"""
+Text with QGIS expressions between [% and %], parsed once and rendered for many features.
+"""
+
+# Same pattern as QgsExpression::replaceExpressionText
+EXPRESSION_BLOCK = re.compile(r"\[%(.*?)%\]", re.DOTALL)
+
+TEMPLATE_CACHE_MAX_SIZE = 100
+
+
+class ExpressionTemplate:
+    """Text with expressions between [% and %].
+
+    The text is split once into literal segments and expressions. Rendering a feature
+    only evaluates the prepared expressions, the result is the same as
+    QgsExpression.replaceExpressionText.
+    A text with a block not parsed is rendered by QgsExpression.replaceExpressionText.
+    """
+
+    def __init__(self, text: str):
+        self.text = text
+        self.has_parser_error = False
+        self._distance_area: Optional[QgsDistanceArea] = None
+        # Literal segments and (expression, original block) pairs
+        self._parts: List[Union[str, Tuple[QgsExpression, str]]] = []
+
+        index = 0
+        for match in EXPRESSION_BLOCK.finditer(text):
+            expression = QgsExpression(match.group(1).strip())
+            if expression.hasParserError():
+                # The block is kept as it is
+                self.has_parser_error = True
+                self._parts.append(text[index : match.end()])
+            else:
+                if match.start() > index:
+                    self._parts.append(text[index : match.start()])
+                self._parts.append((expression, match.group(0)))
+            index = match.end()
+
+        if index < len(text):
+            self._parts.append(text[index:])
+
+    def expressions(self) -> List[QgsExpression]:
+        """The valid expressions of the template."""
+        return [part[0] for part in self._parts if isinstance(part, tuple)]
+
+    def referenced_columns(self) -> Set[str]:
+        """The columns referenced by the expressions.
+
+        It contains QgsFeatureRequest.ALL_ATTRIBUTES if an expression might use any column.
+        """
+        columns = set()
+        for expression in self.expressions():
+            columns.update(expression.referencedColumns())
+        return columns
+
+    def needs_geometry(self) -> bool:
+        """If an expression uses the geometry of the feature."""
+        return any(expression.needsGeometry() for expression in self.expressions())
+
+    def prepare(self, context: QgsExpressionContext, distance_area: Optional[QgsDistanceArea] = None):
+        """Prepare the expressions, to do again when the layer or the fields change."""
+        # Only the geometry calculator, as QgsExpression.replaceExpressionText
+        self._distance_area = distance_area
+        for expression in self.expressions():
+            if distance_area:
+                expression.setGeomCalculator(distance_area)
+            expression.prepare(context)
+
+    def render(self, context: QgsExpressionContext) -> str:
+        """Render the template with the context, the expressions must be prepared."""
+        if self.has_parser_error:
+            return QgsExpression.replaceExpressionText(self.text, context, self._distance_area)
+
+        result = []
+        for part in self._parts:
+            if isinstance(part, str):
+                result.append(part)
+                continue
+
+            expression, block = part
+            value = expression.evaluate(context)
+            if expression.hasEvalError():
+                # The block is kept as it is
+                result.append(block)
+            elif value is None or (isinstance(value, QVariant) and value.isNull()):
+                continue
+            elif isinstance(value, str):
+                result.append(value)
+            else:
+                result.append(QVariant(value).toString())
+        return "".join(result)
+
+
+# Parsed templates by text, they never expire
+_template_cache = TTLCache(TEMPLATE_CACHE_MAX_SIZE, math.inf)
+
+
+def expression_template(text: str) -> ExpressionTemplate:
+    """The parsed template for the text, parsed once.
+
+    Prepare it before rendering, the same template can be shared by different layers.
+    A template with a parser error is not cached.
+    """
+    template = _template_cache.get(text)
+    if template is None:
+        template = ExpressionTemplate(text)
+        if not template.has_parser_error:
+            _template_cache.set(text, template)
+    return template
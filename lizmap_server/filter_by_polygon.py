@@ -1,16 +1,23 @@
 import binascii
+import math
+import os
+import threading
+import time
 
+from collections import OrderedDict
 from enum import Enum, auto
-from functools import lru_cache
 from typing import (
     TYPE_CHECKING,
+    Callable,
+    Dict,
+    List,
+    NamedTuple,
     Optional,
     Tuple,
     Union,
     cast,
 )
 
-from psycopg2 import connect, sql
 from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsCoordinateTransform,
@@ -18,15 +25,15 @@ from qgis.core import (
     QgsFeatureRequest,
     QgsGeometry,
     QgsProject,
-    # NOTE: forgotten in type definitions ?
-    QgsProviderConnectionException,  # ty: ignore[unresolved-import]
     QgsProviderRegistry,
+    QgsRectangle,
     QgsSpatialIndex,
     QgsVectorLayer,
 )
 from qgis.PyQt.QtCore import QVariant
 
-from .tools import to_bool, _N
+from .core import register_request_cache
+from .tools import TTLCache, env_float, to_bool, _N
 from . import logger
 
 
@@ -37,12 +44,391 @@ if TYPE_CHECKING:
 
 CACHE_MAX_SIZE = 100
 
+# Number of seconds to keep the polygons for groups or users across requests
+# With 0, the polygons are only kept during the request
+POLYGON_CACHE_TTL_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_CACHE_TTL"
+POLYGON_CACHE_TTL = 60
+
+# Size of the grid, in the polygon layer units, used to snap the polygons before using them
+# With 0, the polygons are used as they are
+POLYGON_TOLERANCE_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_TOLERANCE"
+
+# Number of seconds between two checks of the tables by the background thread refreshing
+# the subset strings listing the IDs of PostgreSQL layers. With 0, these subset strings are not kept
+MATERIALIZE_INTERVAL_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_MATERIALIZE"
+# Maximum number of seconds a subset string listing the IDs is kept before being computed again,
+# whatever the checks of the tables
+MATERIALIZE_MAX_AGE_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_MATERIALIZE_MAX_AGE"
+MATERIALIZE_MAX_AGE = 300
+# Name of a field holding the last update of a row, used to detect a change in a table
+UPDATED_FIELD_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_UPDATED_FIELD"
+
+# Number of seconds to keep the spatial index of a file based layer across requests
+# The index is rebuilt anyway when the file is modified
+INDEX_CACHE_TTL_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_INDEX_CACHE_TTL"
+INDEX_CACHE_TTL = 3600
+INDEX_CACHE_MAX_SIZE = 20
+
+# Number of cells, by side, of the grid used to find the interior of a polygon
+INTERIOR_GRID_SIZE = 16
+
+# Minimum number of consecutive integer keys written as a BETWEEN instead of a list
+RANGE_MIN_LENGTH = 4
+
+# Maximum length of the subset string listing the keys, 0 for no limit
+# Above, no features of the PostgreSQL layer are returned and a critical message is logged
+SUBSET_MAX_SIZE_KEY = "QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_SUBSET_MAX_SIZE"
+
 # 1 = 0 results in a "false" in OGR/PostGIS
 # ET : I didn't find a proper false value in OGR
 NO_FEATURES = "1 = 0"
 ALL_FEATURES = ""
 
 
+# Union of polygons by (polygon layer ID, source, group field, groups or user)
+_polygon_cache = TTLCache(CACHE_MAX_SIZE, env_float(POLYGON_CACHE_TTL_KEY, POLYGON_CACHE_TTL))
+register_request_cache(_polygon_cache.new_request)
+
+# Spatial index by (layer ID, source, last modification of the files)
+_index_cache = TTLCache(INDEX_CACHE_MAX_SIZE, env_float(INDEX_CACHE_TTL_KEY, INDEX_CACHE_TTL))
+register_request_cache(_index_cache.new_request)
+
+
+class SqlFragment(str):
+    """A piece of SQL, quoted or composed only from quoted pieces."""
+
+
+def quote_identifier(name: str) -> SqlFragment:
+    """Quote a PostgreSQL identifier, as quote_ident does."""
+    return SqlFragment('"{}"'.format(name.replace('"', '""')))
+
+
+def quote_literal(value: str) -> SqlFragment:
+    """Quote a PostgreSQL string literal, as quote_literal does.
+
+    The escape string syntax is used when there is a backslash, so the literal
+    is safe whatever the standard_conforming_strings setting.
+    """
+    value = value.replace("\x00", "").replace("'", "''")
+    if "\\" in value:
+        return SqlFragment("E'{}'".format(value.replace("\\", "\\\\")))
+    return SqlFragment(f"'{value}'")
+
+
+def sql_compose(template: str, **fragments: SqlFragment) -> SqlFragment:
+    """Compose an SQL statement from a constant template and quoted fragments.
+
+    The fragments must come from quote_identifier, quote_literal or another
+    composition, a plain string raises a TypeError.
+    """
+    for name, fragment in fragments.items():
+        if not isinstance(fragment, SqlFragment):
+            raise TypeError(f"The SQL fragment '{name}' is not quoted")
+    # The template is a constant of this module and all the fragments are quoted
+    return SqlFragment(template.format(**fragments))  # nosec B608
+
+
+def sql_query(uri: QgsDataSourceUri, sql: str) -> Tuple[Tuple]:
+    """For a given URI, execute an SQL query and return the result.
+
+    The database connections are pooled by the PostgreSQL provider of QGIS.
+    """
+    # noinspection PyArgumentList
+    metadata = _N(_N(QgsProviderRegistry.instance()).providerMetadata("postgres"))
+    connection = cast("QgsAbstractDatabaseProviderConnection", metadata.createConnection(uri.uri(), {}))
+    return connection.executeSql(sql)
+
+
+def subset_max_size() -> int:
+    """Maximum length of the subset string listing the keys, 0 for no limit."""
+    return max(int(env_float(SUBSET_MAX_SIZE_KEY, 0)), 0)
+
+
+def polygon_tolerance() -> float:
+    """Size of the grid used to snap the polygons, 0 to use them as they are."""
+    return max(env_float(POLYGON_TOLERANCE_KEY, 0), 0)
+
+
+def clear_polygon_cache(polygon_layer_id: Optional[str] = None):
+    """Remove the cached polygons, only the ones from the polygon layer if provided."""
+    if polygon_layer_id is None:
+        _polygon_cache.clear()
+        _materialized_subsets.clear()
+    else:
+        _polygon_cache.invalidate(lambda key: key[0] == polygon_layer_id)
+        _materialized_subsets.invalidate(lambda key: key[2] == polygon_layer_id)
+
+
+class CachedPolygon:
+    """Union of polygons for groups or a user, with its serialized forms."""
+
+    def __init__(self, geometry: QgsGeometry):
+        self.geometry = geometry
+        self._wkt: Dict[int, str] = {}
+        self._ewkt: Dict[Tuple[int, int], str] = {}
+        self._prepared: Dict[Tuple[str, str], "PreparedPolygon"] = {}
+
+    def wkt(self, precision: int) -> str:
+        """The WKT of the polygon, serialized once by precision."""
+        wkt = self._wkt.get(precision)
+        if wkt is None:
+            wkt = self.geometry.asWkt(precision)
+            self._wkt[precision] = wkt
+        return wkt
+
+    def ewkt(self, srid: int, precision: int) -> str:
+        """The EWKT of the polygon, serialized once by SRID and precision."""
+        ewkt = self._ewkt.get((srid, precision))
+        if ewkt is None:
+            ewkt = f"SRID={srid};{self.wkt(precision)}"
+            self._ewkt[(srid, precision)] = ewkt
+        return ewkt
+
+    def prepared(self, transform: QgsCoordinateTransform) -> "PreparedPolygon":
+        """The polygon transformed and prepared, once by source and destination CRS."""
+        # The WKT and not the authid, a custom CRS has an empty authid
+        key = (transform.sourceCrs().toWkt(), transform.destinationCrs().toWkt())
+        prepared = self._prepared.get(key)
+        if prepared is None:
+            polygon = QgsGeometry(self.geometry)
+            polygon.transform(transform)
+            prepared = PreparedPolygon(polygon)
+            self._prepared[key] = prepared
+        return prepared
+
+
+class PreparedPolygon:
+    """Polygon prepared with GEOS for many spatial tests.
+
+    The cells of a grid fully inside the polygon are computed once, a geometry having its
+    bounding box strictly inside one of these cells does not need an exact test.
+    """
+
+    def __init__(self, polygon: QgsGeometry, grid_size: int = INTERIOR_GRID_SIZE):
+        self.polygon = polygon
+        self.engine = _N(QgsGeometry.createGeometryEngine(polygon.constGet()))
+        self.engine.prepareGeometry()
+
+        extent = polygon.boundingBox()
+        self._x_min = extent.xMinimum()
+        self._y_min = extent.yMinimum()
+        self._cell_width = extent.width() / grid_size
+        self._cell_height = extent.height() / grid_size
+        self._interior = set()
+        if self._cell_width <= 0 or self._cell_height <= 0:
+            return
+
+        for column in range(grid_size):
+            for row in range(grid_size):
+                cell = QgsGeometry.fromRect(self._cell(column, row))
+                if self.engine.contains(cell.constGet()):
+                    self._interior.add((column, row))
+
+    def _cell(self, column: int, row: int) -> QgsRectangle:
+        return QgsRectangle(
+            self._x_min + column * self._cell_width,
+            self._y_min + row * self._cell_height,
+            self._x_min + (column + 1) * self._cell_width,
+            self._y_min + (row + 1) * self._cell_height,
+        )
+
+    def is_interior(self, extent: QgsRectangle) -> bool:
+        """If the extent is strictly inside the interior of the polygon."""
+        if not self._interior:
+            return False
+
+        column = int((extent.xMinimum() - self._x_min) // self._cell_width)
+        row = int((extent.yMinimum() - self._y_min) // self._cell_height)
+        if (column, row) not in self._interior:
+            return False
+
+        cell = self._cell(column, row)
+        return (
+            cell.xMinimum() < extent.xMinimum()
+            and extent.xMaximum() < cell.xMaximum()
+            and cell.yMinimum() < extent.yMinimum()
+            and extent.yMaximum() < cell.yMaximum()
+        )
+
+    def intersects(self, geometry: QgsGeometry) -> bool:
+        """If the polygon intersects the geometry."""
+        if geometry.isEmpty():
+            return False
+        if self.is_interior(geometry.boundingBox()):
+            return True
+        return self.engine.intersects(geometry.constGet())
+
+    def contains(self, geometry: QgsGeometry) -> bool:
+        """If the polygon contains the geometry."""
+        if geometry.isEmpty():
+            return False
+        if self.is_interior(geometry.boundingBox()):
+            return True
+        return self.engine.contains(geometry.constGet())
+
+
+def materialize_interval() -> float:
+    """Seconds between two refreshes of the subset strings listing IDs, 0 if they are not kept."""
+    return max(env_float(MATERIALIZE_INTERVAL_KEY, 0), 0)
+
+
+def materialize_max_age() -> float:
+    """Maximum age, in seconds, of a subset string listing IDs."""
+    return max(env_float(MATERIALIZE_MAX_AGE_KEY, MATERIALIZE_MAX_AGE), 0)
+
+
+class MaterializedSubset(NamedTuple):
+    """Subset string listing the IDs of a PostgreSQL layer, with what is needed to refresh it."""
+
+    subset: str
+    # Query listing the IDs, with the primary key to format the subset string
+    layer_uri: str
+    query: str
+    primary_key: str
+    # Queries detecting a change in the filtered and polygon tables, and their last results
+    layer_probe: str
+    layer_state: str
+    polygon_uri: str
+    polygon_probe: str
+    polygon_state: str
+
+
+class MaterializedSubsets:
+    """Bounded cache of subset strings listing the IDs of PostgreSQL layers.
+
+    A background thread probes the tables every `interval` seconds. When the filtered table
+    changed, the subset string is computed again. When the polygon table changed, the subset
+    strings using it are removed, the next request computes them with the new polygons.
+
+    The probes do not see all the changes, an update of a row keeping the number of rows for
+    instance. A subset string older than `max_age` seconds is computed again anyway.
+    """
+
+    def __init__(self, max_size: int, max_age: float = MATERIALIZE_MAX_AGE):
+        self.max_size = max_size
+        self.max_age = max_age
+        # Key -> (creation, entry)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: tuple) -> Optional[str]:
+        """The subset string for the key, None if not materialized or too old."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            created, entry = item
+            if time.monotonic() - created >= self.max_age:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry.subset
+
+    def set(self, key: tuple, entry: MaterializedSubset, interval: float):
+        """Keep the subset string, the background thread is started if needed."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        self.start(interval)
+
+    def invalidate(self, predicate: Callable[[tuple], bool]):
+        """Remove entries having a key matching the predicate."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def start(self, interval: float):
+        """Start the background thread refreshing the subset strings."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(interval,),
+            name="lizmap-filter-by-polygon",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self, interval: float):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Never stop the thread
+                logger.log_exception(e)
+
+    def probe(self, uri: str, probe: str) -> str:
+        """The state of a table, to compare with a previous one."""
+        return str(sql_query(QgsDataSourceUri(uri), probe))
+
+    def refresh(self):
+        """Check the tables and refresh the subset strings of the changed or too old ones."""
+        with self._lock:
+            entries = [(key, created, entry) for key, (created, entry) in self._entries.items()]
+
+        # Probe each table once
+        states = {}
+        for _, _, entry in entries:
+            for uri, probe in (
+                (entry.layer_uri, entry.layer_probe),
+                (entry.polygon_uri, entry.polygon_probe),
+            ):
+                if (uri, probe) not in states:
+                    states[(uri, probe)] = self.probe(uri, probe)
+
+        max_size = subset_max_size()
+        for key, created, entry in entries:
+            if states[(entry.polygon_uri, entry.polygon_probe)] != entry.polygon_state:
+                logger.info(f"The polygon table of the filter by polygon has changed, removing {key[0]}")
+                self.invalidate(lambda k, key=key: k == key)
+                clear_polygon_cache(key[2])
+                continue
+
+            layer_state = states[(entry.layer_uri, entry.layer_probe)]
+            if layer_state == entry.layer_state and time.monotonic() - created < self.max_age:
+                continue
+
+            logger.info(
+                f"The table of the layer {key[0]} filtered by polygon has changed or is old, refreshing"
+            )
+            subset = FilterByPolygon._features_ids_subset(
+                QgsDataSourceUri(entry.layer_uri), entry.query, entry.primary_key
+            )
+            if max_size and len(subset) > max_size:
+                # Same limit as when the subset string is computed for the request
+                logger.warning(
+                    f"The subset string listing the IDs of {key[0]} is too long "
+                    f"({len(subset)} > {max_size}), removing it"
+                )
+                self.invalidate(lambda k, key=key: k == key)
+                continue
+
+            with self._lock:
+                if key in self._entries:
+                    self._entries[key] = (
+                        time.monotonic(),
+                        entry._replace(subset=subset, layer_state=layer_state),
+                    )
+
+
+_materialized_subsets = MaterializedSubsets(CACHE_MAX_SIZE, materialize_max_age())
+
+
 # noinspection PyArgumentList
 class FilterType(Enum):
     QgisExpression = auto()
@@ -65,7 +451,6 @@ class FilterByPolygon:
         :param editing: If the filter must be used only for editing
         :param filter_type: If we generate a QGIS expression or a plain SQL with spatial relationship or not.
         """
-        self.connection: Optional[QgsAbstractDatabaseProviderConnection] = None
         # QGIS Server can consider the ST_Intersect/ST_Contains not safe regarding SQL injection.
         # Using this flag will transform or not the ST_Intersect/ST_Contains into an IN by making the query
         # straight to PostGIS.
@@ -183,20 +568,10 @@ class FilterByPolygon:
 
         return True
 
-    def sql_query(self, uri: QgsDataSourceUri, sql: str) -> Tuple[Tuple]:
+    @staticmethod
+    def sql_query(uri: QgsDataSourceUri, sql: str) -> Tuple[Tuple]:
         """For a given URI, execute an SQL query and return the result."""
-        if self.connection is None:
-            # noinspection PyArgumentList
-            metadata = _N(_N(QgsProviderRegistry.instance()).providerMetadata("postgres"))
-            self.connection = cast(
-                "QgsAbstractDatabaseProviderConnection", metadata.createConnection(uri.uri(), {})
-            )
-            try:
-                self.connection.executeSql("SET application_name='QGIS Lizmap Server : Filter By Polygon';")
-            except QgsProviderConnectionException as e:
-                logger.log_exception(e)
-
-        return self.connection.executeSql(sql)
+        return sql_query(uri, sql)
 
     @logger.profiling
     def subset_sql(self, groups_or_user: tuple) -> Tuple[str, str]:
@@ -224,28 +599,20 @@ class FilterByPolygon:
                 "Layer is editing only AND we are in an editing session. Continue to find the subset string"
             )
 
-        # We need to have a cache for this, valid for the combo polygon layer id & user_groups
         # Check precondition
         if self.polygon is None:
             raise AssertionError("polygon not defined")
 
         # as it will be done for each WMS or WFS query
-        if self.polygon.providerType() == "postgres":
-            polygon = self._polygon_for_groups_with_sql_query(groups_or_user)
-        else:
-            polygon = self._polygon_for_groups_with_qgis_api(groups_or_user)
-        # logger.info("LRU Cache _polygon_for_groups : {}".format(self._polygon_for_groups.cache_info()))
+        cached = self._cached_polygon(groups_or_user)
+        polygon = QgsGeometry(cached.geometry)
 
         if polygon.isEmpty():
             logger.info(f"The polygon is empty, returning default NO_FEATURES {NO_FEATURES}")
-            # Let's try to free the connection
-            self.connection = None
             return NO_FEATURES, ""
 
-        ewkt = "SRID={crs};{wkt}".format(
-            crs=self.polygon.crs().postgisSrid(),
-            wkt=polygon.asWkt(6 if self.polygon.crs().isGeographic() else 2),
-        )
+        precision = self._wkt_precision()
+        ewkt = cached.ewkt(self.polygon.crs().postgisSrid(), precision)
 
         use_st_intersect = self.spatial_relationship != "contains"
 
@@ -256,10 +623,35 @@ class FilterByPolygon:
                 polygon,
                 use_st_intersect,
                 self.use_centroid,
+                wkt=cached.wkt(precision),
             )
             return qgis_expression, ewkt
 
         if self.layer.providerType() == "postgres":
+            interval = materialize_interval()
+            materialized_key = None
+            # The tables are probed with PostgreSQL queries, the polygon layer must be in PostgreSQL too
+            if (
+                interval
+                and self.filter_type == FilterType.SafeSqlQuery
+                and self.polygon.providerType() == "postgres"
+            ):
+                materialized_key = (
+                    self.layer.id(),
+                    self.layer.source(),
+                    self.polygon.id(),
+                    self.polygon.source(),
+                    frozenset(groups_or_user),
+                    self.group_field,
+                    self.primary_key,
+                    self.spatial_relationship,
+                    self.use_centroid,
+                    polygon_tolerance(),
+                )
+                subset = _materialized_subsets.get(materialized_key)
+                if subset is not None:
+                    return subset, ewkt
+
             uri = QgsDataSourceUri(self.layer.source())
             st_relation = self._format_sql_st_relationship(
                 self.layer.sourceCrs(),
@@ -268,6 +660,7 @@ class FilterByPolygon:
                 polygon,
                 use_st_intersect,
                 self.use_centroid,
+                wkt=cached.wkt(precision),
             )
 
             # If we can use the complexe query with ST_Intersects or ST_Contains
@@ -278,19 +671,88 @@ class FilterByPolygon:
 
             # Build the filter with a list of IDS based on a SQL query
             # using the spatial relationship WHERE clause.
-            result = self._features_ids_with_sql_query(st_relation), ewkt
-
-            # Let's try to free the connection
-            self.connection = None
-            return result
+            if materialized_key is not None:
+                # Probe the tables before, a change while listing the IDs will be seen
+                layer_probe = self._table_probe(self.layer)
+                polygon_probe = self._table_probe(self.polygon)
+                layer_state = _materialized_subsets.probe(self.layer.source(), layer_probe)
+                polygon_state = _materialized_subsets.probe(self.polygon.source(), polygon_probe)
+
+            query = self._features_ids_query(st_relation)
+            subset = self._features_ids_subset(uri, query, self.primary_key)
+            max_size = subset_max_size()
+            if max_size and len(subset) > max_size:
+                # The spatial relationship is not safe as a subset string, see above
+                logger.critical(
+                    f"The subset string listing the IDs of {self.layer.name()} is too long ({len(subset)} > "
+                    f"{max_size}), no features are returned. Raise "
+                    f"{SUBSET_MAX_SIZE_KEY} or use a spatial relationship subset string."
+                )
+                return NO_FEATURES, ewkt
+
+            if materialized_key is not None:
+                _materialized_subsets.set(
+                    materialized_key,
+                    MaterializedSubset(
+                        subset=subset,
+                        layer_uri=self.layer.source(),
+                        query=query,
+                        primary_key=self.primary_key,
+                        layer_probe=layer_probe,
+                        layer_state=layer_state,
+                        polygon_uri=self.polygon.source(),
+                        polygon_probe=polygon_probe,
+                        polygon_state=polygon_state,
+                    ),
+                    interval,
+                )
+            return subset, ewkt
 
         # Still here ? So we use the slow method with QGIS API
-        subset = self._features_ids_with_qgis_api(polygon)
+        subset = self._features_ids_with_qgis_api(cached)
         # logger.info("LRU Cache _layer_not_postgres : {}".format(self._layer_not_postgres.cache_info()))
         return subset, ewkt
 
+    def _cached_polygon(self, groups_or_user: tuple) -> CachedPolygon:
+        """The union of polygons for the groups or the user, with its serialized forms.
+
+        The polygon is cached for the combo polygon layer & groups or user,
+        it is shared by all filtered layers and requests.
+        """
+        tolerance = polygon_tolerance()
+        key = (
+            self.polygon.id(),
+            self.polygon.source(),
+            self.group_field,
+            frozenset(groups_or_user),
+            tolerance,
+        )
+        cached = _polygon_cache.get(key)
+        if cached is None:
+            if self.polygon.providerType() == "postgres":
+                polygon = self._polygon_for_groups_with_sql_query(groups_or_user)
+            else:
+                polygon = self._polygon_for_groups_with_qgis_api(groups_or_user)
+
+            if tolerance > 0 and not polygon.isEmpty():
+                polygon = polygon.snappedToGrid(tolerance, tolerance)
+                polygon.removeDuplicateNodes()
+
+            cached = CachedPolygon(polygon)
+            _polygon_cache.set(key, cached)
+
+        return cached
+
+    def _wkt_precision(self) -> int:
+        """Number of decimals when serializing the polygon."""
+        precision = 6 if self.polygon.crs().isGeographic() else 2
+        tolerance = polygon_tolerance()
+        if tolerance > 0:
+            # No need for decimals smaller than the snapping grid
+            precision = min(precision, max(-math.floor(math.log10(tolerance)), 0))
+        return precision
+
     @logger.profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
     def _polygon_for_groups_with_qgis_api(self, groups_or_user: tuple) -> QgsGeometry:
         """All features from the polygon layer corresponding to the user groups or the user"""
         expression = f"""
@@ -317,7 +779,6 @@ array_intersect(
         return QgsGeometry().collectGeometry(polygon_geoms)
 
     @logger.profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
     def _polygon_for_groups_with_sql_query(self, groups_or_user: tuple) -> QgsGeometry:
         """All features from the polygon layer corresponding to the user groups
         or the user for a PostgreSQL layer.
@@ -328,8 +789,8 @@ array_intersect(
         try:
             datasource = QgsDataSourceUri(self.polygon.source())
 
-            # psycopg2 composed request
-            query = sql.SQL("""
+            query = sql_compose(
+                """
 WITH current_groups AS (
     SELECT
         ARRAY_REMOVE(
@@ -360,20 +821,17 @@ c.user_group && (
 
 
 
-""").format(
-                polygon_field=sql.Identifier(self.group_field),
-                groups_or_user=sql.Literal(",".join(groups_or_user)),
-                geom=sql.Identifier(datasource.geometryColumn()),
-                table_name=sql.Identifier(FilterByPolygon._format_table_name(datasource)),
+""",
+                polygon_field=quote_identifier(self.group_field),
+                groups_or_user=quote_literal(",".join(groups_or_user)),
+                geom=quote_identifier(datasource.geometryColumn()),
+                table_name=FilterByPolygon._format_table_name(datasource),
             )
             logger.info(
-                f"Requesting the database about polygons for the current groups or user with : \n{sql}"
+                f"Requesting the database about polygons for the current groups or user with : \n{query}"
             )
 
-            # psycopg2 connection
-            conn = connect(datasource.connectionInfo())
-            # psycopg2 recomposed request as string
-            results = self.sql_query(datasource, query.as_string(conn))
+            results = self.sql_query(datasource, query)
             wkb = results[0][1]
 
             geom = QgsGeometry()
@@ -394,18 +852,36 @@ c.user_group && (
             )
             return self._polygon_for_groups_with_qgis_api(groups_or_user)
 
-    @logger.profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
-    def _features_ids_with_qgis_api(self, polygons: QgsGeometry) -> str:
-        """List all features using the QGIS API.
+    def _layer_last_modified(self) -> Optional[tuple]:
+        """Last modification of the files of the layer, None if it is not file based."""
+        # noinspection PyArgumentList
+        registry = _N(QgsProviderRegistry.instance())
+        path = registry.decodeUri(self.layer.providerType(), self.layer.source()).get("path")
+        if not path:
+            return None
+
+        modified = []
+        # The write-ahead log of a GeoPackage is checked as well
+        for file_path in (path, f"{path}-wal"):
+            try:
+                modified.append(os.stat(file_path).st_mtime_ns)
+            except OSError:
+                modified.append(None)
+        if modified[0] is None:
+            return None
+        return tuple(modified)
 
-        :returns: The subset SQL string.
+    def _spatial_index(self) -> QgsSpatialIndex:
+        """The spatial index of the layer.
+
+        The index of a file based layer is cached until the file is modified.
         """
-        # For other types, we need to find all the ids with an expression
-        # And then search for these ids in the substring, as it must be SQL
+        last_modified = self._layer_last_modified()
+        key = (self.layer.id(), self.layer.source(), last_modified)
+        index = _index_cache.get(key) if last_modified else None
+        if index is not None:
+            return index
 
-        # Build the spatial index
-        index = QgsSpatialIndex()
         logger.info(
             "Building index on {} having CRS {}. The CRS of the polygon is {}".format(
                 self.layer.name(),
@@ -413,80 +889,144 @@ c.user_group && (
                 self.polygon.crs().authid(),
             )
         )
-        index.addFeatures(self.layer.getFeatures())  # ty: ignore[invalid-argument-type]
+        request = QgsFeatureRequest()
+        request.setSubsetOfAttributes([])
+        index = QgsSpatialIndex()
+        index.addFeatures(self.layer.getFeatures(request))  # ty: ignore[invalid-argument-type]
 
-        # Find candidates, if not already in cache
+        if last_modified:
+            # Older indexes of the layer are outdated
+            _index_cache.invalidate(lambda k: k[0] == key[0])
+            _index_cache.set(key, index)
+        return index
+
+    @logger.profiling
+    def _features_ids_with_qgis_api(self, cached: CachedPolygon) -> str:
+        """List all features using the QGIS API.
+
+        :returns: The subset SQL string.
+        """
+        # For other types, we need to find all the ids with an expression
+        # And then search for these ids in the substring, as it must be SQL
+        index = self._spatial_index()
+
+        # The polygon in the layer CRS, prepared once for all the layers in this CRS
         # NOTE: QGIS 4 incomplete type annotations (missing constructors)
         transform = QgsCoordinateTransform(self.polygon.crs(), self.layer.crs(), self.project)  # ty: ignore
-        polygons.transform(transform)
-        candidates = index.intersects(polygons.boundingBox())
+        prepared = cached.prepared(transform)
+
+        # Find candidates, if not already in cache
+        candidates = index.intersects(prepared.polygon.boundingBox())
         if not candidates:
             logger.info(
                 f"Not features in the index matching the bounding box, return the default value {NO_FEATURES}"
             )
             return NO_FEATURES
 
-        # Check real intersection for the candidates
+        if self.spatial_relationship == "contains":
+            relation = prepared.contains
+        elif self.spatial_relationship == "intersects":
+            relation = prepared.intersects
+        else:
+            raise Exception("Spatial relationship unknown")
+
+        # Check real intersection for the candidates, fetched at once with only the primary key
+        request = QgsFeatureRequest()
+        request.setFilterFids(candidates)
+        request.setSubsetOfAttributes([self.primary_key], self.layer.fields())
+
         unique_ids = []
-        for candidate_id in candidates:
-            feature = self.layer.getFeature(candidate_id)
-            if self.spatial_relationship == "contains":
-                if feature.geometry().contains(polygons):
-                    unique_ids.append(feature[self.primary_key])
-            elif self.spatial_relationship == "intersects":
-                if feature.geometry().intersects(polygons):
-                    unique_ids.append(feature[self.primary_key])
-            else:
-                raise Exception("Spatial relationship unknown")
+        for feature in self.layer.getFeatures(request):  # ty: ignore[not-iterable]
+            if relation(feature.geometry()):
+                unique_ids.append(feature[self.primary_key])
 
         # logger.info("Unique ids = {}".format(','.join([str(f) for f in unique_ids])))
         return self._format_sql_in(self.primary_key, unique_ids)
 
-    @logger.profiling
-    @lru_cache(maxsize=CACHE_MAX_SIZE)
-    def _features_ids_with_sql_query(self, st_intersect: str) -> str:
-        """List all features using a SQL query.
+    def _features_ids_query(self, st_intersect: SqlFragment) -> SqlFragment:
+        """The SQL query listing the IDs of the features, using the spatial relationship.
 
         Only for QGIS >= 3.10
-
-        :returns: The subset SQL string.
         """
-        datasource = QgsDataSourceUri(self.layer.source())
-
-        # psycopg2 composed request
-        query = sql.SQL("""
+        return sql_compose(
+            """
             SELECT {pk} FROM {table_name} WHERE {st_intersect}
-        """).format(
-            pk=sql.Identifier(self.primary_key),
-            table_name=sql.SQL(FilterByPolygon._format_table_name(datasource)),
-            st_intersect=sql.SQL(st_intersect),
+        """,
+            pk=quote_identifier(self.primary_key),
+            table_name=FilterByPolygon._format_table_name(QgsDataSourceUri(self.layer.source())),
+            st_intersect=st_intersect,
         )
 
-        # psycopg2 connection
-        conn = connect(datasource.connectionInfo())
-        # psycopg2 recomposed request as string
-        query_string = query.as_string(conn)
-        logger.info(f"Requesting the database about IDs to filter with {query_string[0:90]}...")
-        results = self.sql_query(datasource, query_string)
-        unique_ids = [str(row[0]) for row in results]
+    @classmethod
+    @logger.profiling
+    def _features_ids_subset(
+        cls,
+        datasource: QgsDataSourceUri,
+        query: str,
+        primary_key: str,
+    ) -> str:
+        """Execute the query listing the IDs and format the subset string."""
+        logger.info(f"Requesting the database about IDs to filter with {query[0:90]}...")
+        results = sql_query(datasource, query)
+        unique_ids = [row[0] if isinstance(row[0], int) else str(row[0]) for row in results]
 
-        return self._format_sql_in(self.primary_key, unique_ids)
+        return cls._format_sql_in(primary_key, unique_ids)
+
+    @classmethod
+    def _table_probe(cls, layer: QgsVectorLayer) -> SqlFragment:
+        """The SQL query detecting a change in the table of the layer."""
+        table_name = cls._format_table_name(QgsDataSourceUri(layer.source()))
+        updated_field = os.getenv(UPDATED_FIELD_KEY, "")
+        if updated_field and layer.fields().indexOf(updated_field) >= 0:
+            return sql_compose(
+                "SELECT count(*), max({field})::text FROM {table_name} AS t",
+                field=quote_identifier(updated_field),
+                table_name=table_name,
+            )
+        return sql_compose("SELECT count(*) FROM {table_name} AS t", table_name=table_name)
 
     @classmethod
     def _format_sql_in(cls, primary_key: str, values: Union[list, Tuple]) -> str:
-        """Format the SQL IN statement."""
+        """Format the SQL IN statement.
+
+        Consecutive integers are compressed into BETWEEN ranges.
+        """
         if not values:
             logger.info(f"No values, returning default NO VALUES {NO_FEATURES}")
             return NO_FEATURES
 
-        cleaned = []
-        for value in values:
-            if isinstance(value, str):
-                cleaned.append(f"'{value}'")
-            else:
-                cleaned.append(str(value))
+        field = quote_identifier(primary_key)
+        if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+            ranges, values = cls._integer_ranges(values)
+            terms = [f"{field} BETWEEN {start} AND {end}" for start, end in ranges]
+        else:
+            terms = []
+
+        cleaned = [quote_literal(value) if isinstance(value, str) else str(value) for value in values]
 
-        return f'"{primary_key}" IN ( {" , ".join(cleaned)} )'
+        if cleaned:
+            terms.append(f"{field} IN ( {' , '.join(cleaned)} )")
+
+        if len(terms) == 1:
+            return terms[0]
+        return f"( {' OR '.join(terms)} )"
+
+    @classmethod
+    def _integer_ranges(cls, values: Union[list, Tuple]) -> Tuple[List[Tuple[int, int]], List[int]]:
+        """Split integers into ranges of consecutive values and remaining values, both sorted."""
+        ranges = []
+        singles = []
+        ordered = sorted(set(values))
+        start = 0
+        for i in range(1, len(ordered) + 1):
+            if i < len(ordered) and ordered[i] == ordered[i - 1] + 1:
+                continue
+            if i - start >= RANGE_MIN_LENGTH:
+                ranges.append((ordered[start], ordered[i - 1]))
+            else:
+                singles.extend(ordered[start:i])
+            start = i
+        return ranges, singles
 
     @classmethod
     def _format_sql_st_relationship(
@@ -497,26 +1037,31 @@ c.user_group && (
         polygons: QgsGeometry,
         use_st_intersect: bool,
         use_centroid: bool,
-    ) -> str:
+        wkt: Optional[str] = None,
+    ) -> SqlFragment:
         """If layer is of type PostgreSQL, use a simple ST_Intersects/ST_Contains.
 
+        :param wkt: The WKT of the polygons if already serialized
         :returns: The subset SQL string.
         """
-        geom = f"ST_GeomFromText('{polygons.asWkt(6 if filtering_crs.isGeographic() else 2)}')"
+        if wkt is None:
+            wkt = polygons.asWkt(6 if filtering_crs.isGeographic() else 2)
+        geom = f"ST_GeomFromText('{wkt}')"
         geom = f"ST_SetSRID({geom}, {filtering_crs.postgisSrid()})"
         if filtering_crs != filtered_crs:
             geom = f"ST_Transform({geom}, {filtered_crs.postgisSrid()})"
 
         if use_centroid:
-            geom_field = f'ST_Centroid("{geom_field}")'
+            geom_field = f"ST_Centroid({quote_identifier(geom_field)})"
         else:
-            geom_field = f'"{geom_field}"'
+            geom_field = quote_identifier(geom_field)
 
-        return f"""
+        # The WKT of a geometry and the SRIDs do not need to be quoted
+        return SqlFragment(f"""
 ST_{"Intersects" if use_st_intersect else "Contains"}(
     {geom},
     {geom_field}
-)"""
+)""")
 
     @classmethod
     def _format_qgis_expression_relationship(
@@ -526,14 +1071,16 @@ ST_{"Intersects" if use_st_intersect else "Contains"}(
         polygons: QgsGeometry,
         use_st_intersect: bool,
         use_centroid: bool,
+        wkt: Optional[str] = None,
     ) -> str:
         """Build the filter with a QGIS expression.
 
+        :param wkt: The WKT of the polygons if already serialized
         :returns: The QGIS expression
         """
-        geom = "geom_from_wkt('{wkt}')".format(
-            wkt=polygons.asWkt(6 if filtering_crs.isGeographic() else 2),
-        )
+        if wkt is None:
+            wkt = polygons.asWkt(6 if filtering_crs.isGeographic() else 2)
+        geom = f"geom_from_wkt('{wkt}')"
         if filtering_crs != filtered_crs:
             geom = "transform({geom}, '{from_crs}', '{to_crs}')".format(
                 geom=geom,
@@ -553,12 +1100,12 @@ ST_{"Intersects" if use_st_intersect else "Contains"}(
 )"""
 
     @classmethod
-    def _format_table_name(cls, uri: QgsDataSourceUri) -> str:
+    def _format_table_name(cls, uri: QgsDataSourceUri) -> SqlFragment:
         """Format the table name according to the URI."""
         table_name = uri.table()
         # is the datasource a query or a table ?
         if not uri.schema() and table_name.startswith("(") and table_name.endswith(")"):
-            # it is a query
-            return table_name
+            # it is a query, written in the project by the publisher
+            return SqlFragment(table_name)
         # it is a table
-        return uri.quotedTablename()
+        return SqlFragment(uri.quotedTablename())
@@ -1,11 +1,12 @@
-import json
+import math
 
 from collections import namedtuple
 from pathlib import Path
-from typing import Generator, List, Tuple, Union
+from typing import Dict, Generator, List, Optional, Set, Tuple, Union
 
 from qgis.core import (
     Qgis,
+    QgsApplication,
     QgsDistanceArea,
     QgsEditFormConfig,
     QgsExpression,
@@ -15,12 +16,21 @@ from qgis.core import (
     QgsFeatureRequest,
     QgsProject,
     QgsRelationManager,
+    QgsVectorLayer,
 )
 from qgis.server import QgsServerFeatureId, QgsServerFilter, QgsServerProjectUtils
-from qgis.PyQt.QtXml import QDomDocument
-
-from .core import find_vector_layer
-from .tools import to_bool, _N
+from qgis.PyQt.QtCore import QVariant
+from qgis.PyQt.QtXml import QDomDocument, QDomElement
+
+from .core import (
+    LizmapConfigView,
+    find_vector_layer,
+    get_lizmap_config_view,
+    project_layer_index,
+    register_request_cache,
+)
+from .expression_template import ExpressionTemplate, expression_template
+from .tools import TTLCache, env_float, to_bool, _N
 from .tooltip import InvalidWidgetConfig, Tooltip
 
 from . import logger
@@ -31,13 +41,36 @@ QGIS Server filter for the GetFeatureInfo according to CFG config.
 
 Result = namedtuple("Result", ["layer", "feature_id", "expression"])
 
+POPUP_CACHE_MAX_SIZE = 100
+
+# Popup templates from the drag and drop forms, they never expire
+_popup_cache = TTLCache(POPUP_CACHE_MAX_SIZE, math.inf)
+
+REPRESENT_VALUE_CACHE_MAX_SIZE = 10000
+REPRESENT_VALUE_CACHE_TTL_KEY = "QGIS_SERVER_LIZMAP_REPRESENT_VALUE_CACHE_TTL"
+
+# Widgets represented from another layer
+REPRESENT_VALUE_WIDGETS = ("ValueRelation", "RelationReference")
+
+# Same key as the cache of the represent_value function in the QGIS expression context
+REPRESENT_VALUE_CONTEXT_KEY = "repvalfcnval:{}:{}:{}"
+
+# Represented values by (project, layer ID, field name, key), kept during the request by default
+_represent_value_cache = TTLCache(REPRESENT_VALUE_CACHE_MAX_SIZE, env_float(REPRESENT_VALUE_CACHE_TTL_KEY, 0))
+register_request_cache(_represent_value_cache.new_request)
+
 
 class GetFeatureInfoFilter(QgsServerFilter):
     @classmethod
-    def parse_xml(cls, string: str) -> Generator[Tuple[str, str], None, None]:
-        """Generator for layer and feature found in the XML GetFeatureInfo."""
+    def parse_document(cls, string: str) -> QDomDocument:
+        """Parse the XML GetFeatureInfo."""
         dom_doc = QDomDocument("gfi")
         dom_doc.setContent(string)
+        return dom_doc
+
+    @classmethod
+    def feature_elements(cls, dom_doc: QDomDocument) -> Generator[Tuple[str, str, QDomElement], None, None]:
+        """Generator for layer, feature and feature element found in the XML GetFeatureInfo."""
         doc_elem = dom_doc.documentElement()
 
         layer_elem = doc_elem.firstChildElement()
@@ -49,54 +82,48 @@ class GetFeatureInfoFilter(QgsServerFilter):
             feature_elem = layer_elem.firstChildElement()
             while not feature_elem.isNull():
                 if feature_elem.hasAttribute("id"):
-                    yield layer_elem.attribute("name"), feature_elem.attribute('id')
+                    yield layer_elem.attribute("name"), feature_elem.attribute("id"), feature_elem
 
                 feature_elem = feature_elem.nextSiblingElement()
 
             layer_elem = layer_elem.nextSiblingElement()
 
     @classmethod
-    def append_maptip(cls, string: str, layer_name: str, feature_id: Union[str, int], maptip: str) -> str:
-        """Edit the XML GetFeatureInfo by adding a maptip for a given layer and feature ID."""
-        dom_doc = QDomDocument("gfi")
-        dom_doc.setContent(string)
-        doc_elem = dom_doc.documentElement()
-        layer_elem = doc_elem.firstChildElement()
-        while not layer_elem.isNull():
-            if layer_elem.nodeName().upper() != "LAYER":
-                layer_elem = layer_elem.nextSiblingElement()
-                continue
+    def parse_xml(cls, xml: Union[str, QDomDocument]) -> Generator[Tuple[str, str], None, None]:
+        """Generator for layer and feature found in the XML GetFeatureInfo."""
+        dom_doc = cls.parse_document(xml) if isinstance(xml, str) else xml
+        for layer_name, feature_id, _ in cls.feature_elements(dom_doc):
+            yield layer_name, feature_id
 
-            if layer_elem.attribute("name") != layer_name:
-                layer_elem = layer_elem.nextSiblingElement()
+    @classmethod
+    def set_maptips(cls, dom_doc: QDomDocument, maptips: Dict[Tuple[str, str], str]):
+        """Edit the XML GetFeatureInfo by setting the maptips, by layer and feature ID, in a single pass."""
+        for layer_name, feature_id, feature_elem in cls.feature_elements(dom_doc):
+            maptip = maptips.get((layer_name, feature_id))
+            if maptip is None:
                 continue
 
-            feature_elem = layer_elem.firstChildElement()
-            while not feature_elem.isNull():
-                if feature_elem.attribute("id") != str(feature_id):
-                    feature_elem = feature_elem.nextSiblingElement()
-                    continue
-
-                # We found the feature, now we look for the maptip attribute
-                maptip_found = False
-                attr_elem = feature_elem.firstChildElement()
-                while not attr_elem.isNull():
-                    if attr_elem.attribute("name") == "maptip":
-                        attr_elem.setAttribute("value", maptip)
-                        maptip_found = True
-                        break
-                    attr_elem = attr_elem.nextSiblingElement()
-
-                if not maptip_found:
-                    attr_elem = dom_doc.createElement("Attribute")
-                    attr_elem.setAttribute("name", "maptip")
+            # We found the feature, now we look for the maptip attribute
+            maptip_found = False
+            attr_elem = feature_elem.firstChildElement()
+            while not attr_elem.isNull():
+                if attr_elem.attribute("name") == "maptip":
                     attr_elem.setAttribute("value", maptip)
-                    feature_elem.appendChild(attr_elem)
-
-                break
+                    maptip_found = True
+                    break
+                attr_elem = attr_elem.nextSiblingElement()
 
-            break
+            if not maptip_found:
+                attr_elem = dom_doc.createElement("Attribute")
+                attr_elem.setAttribute("name", "maptip")
+                attr_elem.setAttribute("value", maptip)
+                feature_elem.appendChild(attr_elem)
 
+    @classmethod
+    def append_maptip(cls, string: str, layer_name: str, feature_id: Union[str, int], maptip: str) -> str:
+        """Edit the XML GetFeatureInfo by adding a maptip for a given layer and feature ID."""
+        dom_doc = cls.parse_document(string)
+        cls.set_maptips(dom_doc, {(layer_name, str(feature_id)): maptip})
         return dom_doc.toString()
 
     @classmethod
@@ -105,7 +132,7 @@ class GetFeatureInfoFilter(QgsServerFilter):
         cfg: dict,
         project: QgsProject,
         relation_manager: QgsRelationManager,
-        xml: str,
+        xml: Union[str, QDomDocument],
         css_framework: str,
     ) -> List[Result]:
         """Parse the XML and check for each layer according to the Lizmap CFG file."""
@@ -149,30 +176,8 @@ class GetFeatureInfoFilter(QgsServerFilter):
                 )
                 continue
 
-            root = config.invisibleRootContainer()
-
             # Need to eval the html_content
-            html_content = Tooltip.create_popup_node_item_from_form(
-                layer,
-                root,
-                0,
-                [],
-                "",
-                relation_manager,
-                css_framework == "BOOTSTRAP5",
-            )
-            html_content = Tooltip.create_popup(html_content)
-
-            # If CSS_FRAMEWORK is empty (empty string), it means :
-            # LWC <= 3.7.X
-            # LWC between 3.8.0 and 3.8.6 included
-            # We include so the CSS
-            # Starting from 3.8.7, the CSS is included into LWC itself
-            # Because the Lizmap server 2.13.0 is a hard dependency to LWC 3.8.7, the CSS will be obviously provided by
-            # LWC core, so no call to Tooltip::css_3_8_6() on the server side, only in desktop.
-            if css_framework == "":
-                # Maybe we can avoid the CSS on all features ?
-                html_content += Tooltip.css
+            html_content = cls.form_popup(layer, config, project, relation_manager, css_framework)
 
             features.append(Result(layer, feature_id, html_content))
             logger.info(
@@ -180,6 +185,206 @@ class GetFeatureInfoFilter(QgsServerFilter):
             )
         return features
 
+    @classmethod
+    def form_popup(
+        cls,
+        layer: QgsVectorLayer,
+        config: QgsEditFormConfig,
+        project: QgsProject,
+        relation_manager: QgsRelationManager,
+        css_framework: str,
+    ) -> str:
+        """The popup template, as an expression, from the drag and drop form of the layer.
+
+        The template is cached by project, layer and CSS framework.
+        The project is reloaded by QGIS Server when its file is modified, so is the form.
+        """
+        key = (
+            project.fileName(),
+            project.lastModified().toMSecsSinceEpoch(),
+            layer.id(),
+            css_framework,
+        )
+        html_content = _popup_cache.get(key)
+        if html_content is not None:
+            return html_content
+
+        html_content = Tooltip.create_popup_node_item_from_form(
+            layer,
+            config.invisibleRootContainer(),
+            0,
+            [],
+            "",
+            relation_manager,
+            css_framework == "BOOTSTRAP5",
+        )
+        html_content = Tooltip.create_popup(html_content)
+
+        # If CSS_FRAMEWORK is empty (empty string), it means :
+        # LWC <= 3.7.X
+        # LWC between 3.8.0 and 3.8.6 included
+        # We include so the CSS
+        # Starting from 3.8.7, the CSS is included into LWC itself
+        # Because the Lizmap server 2.13.0 is a hard dependency to LWC 3.8.7, the CSS will be obviously provided by
+        # LWC core, so no call to Tooltip::css_3_8_6() on the server side, only in desktop.
+        if css_framework == "":
+            # Maybe we can avoid the CSS on all features ?
+            html_content += Tooltip.css
+
+        _popup_cache.set(key, html_content)
+        return html_content
+
+    @classmethod
+    def fetch_features(cls, results: List[Result], with_geometry: bool) -> Dict[Tuple[str, str], QgsFeature]:
+        """Fetch the features of the results, with a single request by layer.
+
+        :returns: The features by layer ID and server feature ID.
+        """
+        results_by_layer: Dict[str, List[Result]] = {}
+        for result in results:
+            results_by_layer.setdefault(result.layer.id(), []).append(result)
+
+        features = {}
+        for layer_results in results_by_layer.values():
+            layer = layer_results[0].layer
+            provider = _N(layer.dataProvider())
+
+            # The popup is the same for all the features of the layer
+            template = expression_template(layer_results[0].expression)
+            attributes = cls.required_attributes(layer, template)
+            no_geometry = not with_geometry and not template.needs_geometry()
+
+            expressions = []
+            feature_ids = []
+            for result in layer_results:
+                expression = QgsServerFeatureId.getExpressionFromServerFid(str(result.feature_id), provider)
+                if expression:
+                    expressions.append(f"( {expression} )")
+                else:
+                    # If not expression, the feature ID must be integer
+                    feature_ids.append(int(result.feature_id))
+
+            if expressions:
+                request = QgsFeatureRequest(QgsExpression(" OR ".join(expressions)))
+                if no_geometry:
+                    # TODO: change when deprecating QGIS 3.34
+                    # Only with QGIS >= 3.36
+                    # request.setFlags(Qgis.FeatureRequestFlag.NoGeometry)
+                    request.setFlags(QgsFeatureRequest.Flag.NoGeometry)  # ty: ignore [unresolved-attribute]
+                if attributes is not None:
+                    request.setSubsetOfAttributes(attributes)
+                pk_attributes = provider.pkAttributeIndexes()
+                for feature in layer.getFeatures(request):  # ty: ignore[not-iterable]
+                    features[(layer.id(), QgsServerFeatureId.getServerFid(feature, pk_attributes))] = feature
+
+            if feature_ids:
+                request = QgsFeatureRequest()
+                request.setFilterFids(feature_ids)
+                if attributes is not None:
+                    request.setSubsetOfAttributes(attributes)
+                for feature in layer.getFeatures(request):  # ty: ignore[not-iterable]
+                    features[(layer.id(), str(feature.id()))] = feature
+
+        return features
+
+    @classmethod
+    def required_attributes(cls, layer: QgsVectorLayer, template: ExpressionTemplate) -> Optional[List[int]]:
+        """The attribute indexes needed to render the popup, None if all the attributes are needed.
+
+        Besides the columns of the expressions, the primary keys and the keys of the relations are kept.
+        """
+        columns = template.referenced_columns()
+        if QgsFeatureRequest.ALL_ATTRIBUTES in columns:
+            return None
+
+        fields = layer.fields()
+        attributes = {fields.lookupField(name) for name in columns}
+        attributes.update(_N(layer.dataProvider()).pkAttributeIndexes())
+
+        relation_manager = _N(_N(QgsProject.instance()).relationManager())
+        for relation in relation_manager.referencedRelations(layer):
+            attributes.update(relation.referencedFields())
+        for relation in relation_manager.referencingRelations(layer):
+            attributes.update(relation.referencingFields())
+
+        attributes.discard(-1)
+        return sorted(attributes)
+
+    @classmethod
+    def represent_values(
+        cls,
+        layer: QgsVectorLayer,
+        features: List[QgsFeature],
+        columns: Set[str],
+    ) -> Dict[Tuple[str, str], str]:
+        """The represented values of the ValueRelation and RelationReference fields used by the popup.
+
+        The values are computed in bulk for the keys of the features, the referenced layer is read
+        once by field.
+
+        :returns: The represented values by field name and key.
+        """
+        project = _N(QgsProject.instance())
+        registry = _N(QgsApplication.fieldFormatterRegistry())
+
+        values = {}
+        for index, field in enumerate(layer.fields()):
+            if field.name() not in columns:
+                continue
+
+            setup = field.editorWidgetSetup()
+            if setup.type() not in REPRESENT_VALUE_WIDGETS:
+                continue
+
+            keys = {}
+            for feature in features:
+                value = feature.attribute(index)
+                if value is None or (isinstance(value, QVariant) and value.isNull()):
+                    continue
+                keys[QVariant(value).toString()] = value
+
+            formatter = registry.fieldFormatter(setup.type())
+            formatter_cache = None
+            for key, value in keys.items():
+                cache_key = (
+                    project.fileName(),
+                    project.lastModified().toMSecsSinceEpoch(),
+                    layer.id(),
+                    field.name(),
+                    key,
+                )
+                represented = _represent_value_cache.get(cache_key)
+                if represented is None:
+                    if formatter_cache is None:
+                        formatter_cache = formatter.createCache(layer, index, setup.config())
+                    represented = formatter.representValue(
+                        layer, index, setup.config(), formatter_cache, value
+                    )
+                    _represent_value_cache.set(cache_key, represented)
+                values[(field.name(), key)] = represented
+
+        return values
+
+    @classmethod
+    def query_form_popup(cls, cfg: LizmapConfigView, project: QgsProject, query_layers: str) -> bool:
+        """If one of the queried layers might have a popup from the drag and drop form.
+
+        A name which is not a layer, a group for instance, might contain one.
+        """
+        if not cfg.form_popup_layers:
+            return False
+
+        if not query_layers:
+            return True
+
+        index = project_layer_index(project)
+        for layer_name in query_layers.split(","):
+            layer = index.find(layer_name, project)
+            if layer is None or layer.name() in cfg.form_popup_layers:
+                return True
+
+        return False
+
     def responseComplete(self):
         """Intercept the GetFeatureInfo and add the form maptip if needed."""
         server_iface = _N(self.serverInterface())
@@ -202,39 +407,38 @@ class GetFeatureInfoFilter(QgsServerFilter):
             return
 
         project_path = Path(server_iface.configFilePath())
-        if not project_path.exists():
+        # The Lizmap config is cached, the file is checked at most once per request
+        cfg = get_lizmap_config_view(server_iface.configFilePath())
+        if cfg is None:
             logger.info(
-                "The QGIS project {} does not exist as a file, not possible to process with Lizmap this "
+                "The QGIS project {} is not a Lizmap project, not possible to process with Lizmap this "
                 "request GetFeatureInfo".format(server_iface.configFilePath())
             )
             return
 
-        config_path = Path(server_iface.configFilePath() + ".cfg")
-        if not config_path.exists():
+        project = _N(QgsProject.instance())
+        if not self.query_form_popup(cfg, project, params.get("QUERY_LAYERS", "")):
             logger.info(
-                "The QGIS project {} is not a Lizmap project, not possible to process with Lizmap this "
-                "request GetFeatureInfo".format(server_iface.configFilePath())
+                "No layer having a popup from the drag and drop form in the request GetFeatureInfo for "
+                "project {}".format(project_path)
             )
             return
 
-        # str() because the plugin must be compatible Python 3.5
-        with open(str(config_path), encoding="utf-8") as cfg_file:
-            cfg = json.loads(cfg_file.read())
-
-        project = _N(QgsProject.instance())
         relation_manager = _N(project.relationManager())
 
         xml = request.body().data().decode("utf-8")
+        # The XML is parsed once, then edited in place
+        dom_doc = self.parse_document(xml)
 
         css_framework = params.get("CSS_FRAMEWORK", "")
 
         # noinspection PyBroadException
         try:
-            features = self.feature_list_to_replace(cfg, project, relation_manager, xml, css_framework)
-        except InvalidWidgetConfig as e:
-            logger.warning(
-                f"A field widget config has been invalid: {e}"
+            features = self.feature_list_to_replace(
+                cfg.cfg, project, relation_manager, dom_doc, css_framework
             )
+        except InvalidWidgetConfig as e:
+            logger.warning(f"A field widget config has been invalid: {e}")
             # For embedded layer the widget config is empty, so the form could not be
             # translated to HTML. The default response is returned.
             return
@@ -268,29 +472,41 @@ class GetFeatureInfoFilter(QgsServerFilter):
         # retrieve geometry from getFeatureInfo project server properties
         geometry_result = QgsServerProjectUtils.wmsFeatureInfoAddWktGeometry(project)
 
+        maptips = {}
+        prepared = None
         # noinspection PyBroadException
         try:
+            # A single request by layer to fetch the features
+            fetched_features = self.fetch_features(features, geometry_result)
+
+            current_layer = None
+            distance_area = QgsDistanceArea()
             for result in features:
-                distance_area = QgsDistanceArea()
-                distance_area.setSourceCrs(result.layer.crs(), project.transformContext())
-                distance_area.setEllipsoid(project.ellipsoid())
-                exp_context.appendScope(QgsExpressionContextUtils.layerScope(result.layer))
+                if current_layer != result.layer.id():
+                    current_layer = result.layer.id()
+                    distance_area = QgsDistanceArea()
+                    distance_area.setSourceCrs(result.layer.crs(), project.transformContext())
+                    distance_area.setEllipsoid(project.ellipsoid())
+                    exp_context.appendScope(QgsExpressionContextUtils.layerScope(result.layer))
+
+                    # Values from other layers, read once for all the features of the layer
+                    represented = self.represent_values(
+                        result.layer,
+                        [
+                            feature
+                            for (layer_id, _), feature in fetched_features.items()
+                            if layer_id == current_layer
+                        ],
+                        expression_template(result.expression).referenced_columns(),
+                    )
+                    for (field_name, key), value in represented.items():
+                        exp_context.setCachedValue(
+                            REPRESENT_VALUE_CONTEXT_KEY.format(current_layer, field_name, key), value
+                        )
 
-                expression = QgsServerFeatureId.getExpressionFromServerFid(
-                    result.feature_id, result.layer.dataProvider()
-                )
-                if expression:
-                    expression_request = QgsFeatureRequest(QgsExpression(expression))
-                    if not geometry_result:
-                        # TODO: change when deprecating QGIS 3.34
-                        # Only with QGIS >= 3.36
-                        # expression_request.setFlags(Qgis.FeatureRequestFlag.NoGeometry)
-                        expression_request.setFlags(QgsFeatureRequest.Flag.NoGeometry)  # ty: ignore [unresolved-attribute]
+                feature = fetched_features.get((result.layer.id(), str(result.feature_id)))
+                if feature is None:
                     feature = QgsFeature()
-                    result.layer.getFeatures(expression_request).nextFeature(feature)
-                else:
-                    # If not expression, the feature ID must be integer
-                    feature = result.layer.getFeature(int(result.feature_id))
 
                 if not feature.isValid():
                     logger.warning(
@@ -304,7 +520,13 @@ class GetFeatureInfoFilter(QgsServerFilter):
                 exp_context.setFeature(feature)
                 exp_context.setFields(feature.fields())
 
-                value = QgsExpression.replaceExpressionText(result.expression, exp_context, distance_area)
+                # The popup is parsed once, its expressions are prepared once by layer
+                template = expression_template(result.expression)
+                if prepared != (result.layer.id(), template):
+                    template.prepare(exp_context, distance_area)
+                    prepared = (result.layer.id(), template)
+
+                value = template.render(exp_context)
                 if not value:
                     logger.warning(
                         "The GetFeatureInfo result for feature {} in layer {} is not valid, skip replacing "
@@ -326,7 +548,14 @@ class GetFeatureInfoFilter(QgsServerFilter):
                         result.feature_id, layer_name
                     )
                 )
-                xml = self.append_maptip(xml, layer_name, result.feature_id, value)
+                maptips[(layer_name, str(result.feature_id))] = value
+
+            if not maptips:
+                logger.info(f"No maptip to replace in the GetFeatureInfo for project {project_path}")
+                return
+
+            self.set_maptips(dom_doc, maptips)
+            xml = dom_doc.toString()
 
             # Safeguard, it shouldn't happen
             if not xml:
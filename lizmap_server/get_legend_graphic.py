@@ -6,30 +6,52 @@
 # File adapted by @rldhont and @Gustry, 3Liz
 
 import json
+import math
 import re
 
 from collections import namedtuple
 from typing import (
+    Dict,
     Optional,
+    Tuple,
     cast,
 )
 
-from qgis.core import Qgis, QgsProject, QgsVectorLayer
+from qgis.core import Qgis, QgsFeatureRenderer, QgsProject, QgsReadWriteContext, QgsVectorLayer
 from qgis.PyQt.QtCore import QBuffer, QIODevice
 from qgis.PyQt.QtGui import QImage
+from qgis.PyQt.QtXml import QDomDocument
 from qgis.server import QgsServerFilter
 
 from lizmap_server import logger
-from lizmap_server.core import find_layer
+from lizmap_server.core import find_layer, register_request_cache
 from lizmap_server.tools import to_bool
 
-from .tools import _N
+from .tools import TTLCache, env_float, _N
 
 Category = namedtuple(
     "Category",
     ["ruleKey", "checked", "parentRuleKey", "scaleMaxDenom", "scaleMinDenom", "expression", "title"],
 )
 
+LEGEND_CACHE_MAX_SIZE = 100
+
+# Categories of the legends, without the check state and the feature count, they never expire
+_legend_cache = TTLCache(LEGEND_CACHE_MAX_SIZE, math.inf)
+
+# Renderers of the styles which are not the current one, they never expire
+_renderer_cache = TTLCache(LEGEND_CACHE_MAX_SIZE, math.inf)
+
+# Legends of the invalid layers by layer name, they never expire
+_invalid_legend_cache = TTLCache(LEGEND_CACHE_MAX_SIZE, math.inf)
+
+FEATURE_COUNT_CACHE_TTL_KEY = "QGIS_SERVER_LIZMAP_LEGEND_FEATURE_COUNT_TTL"
+
+# Feature counts of the legends, by project, layer, style and subset string
+# Kept during the request by default, the data can be edited outside QGIS Server
+_feature_count_cache = TTLCache(LEGEND_CACHE_MAX_SIZE, env_float(FEATURE_COUNT_CACHE_TTL_KEY, 0))
+register_request_cache(_feature_count_cache.new_request)
+
 
 class GetLegendGraphicFilter(QgsServerFilter):
     """Add "ruleKey" to GetLegendGraphic for categorized and rule-based
@@ -43,14 +65,39 @@ class GetLegendGraphicFilter(QgsServerFilter):
         """Regexp for extracting the feature count from the label."""
         return re.match(cls.FEATURE_COUNT_REGEXP, symbol_label)
 
+    # The warning icon, rendered once
+    _warning_icon: Optional[str] = None
+
     @classmethod
     def warning_icon(cls) -> str:
         """Warning icon as base 64."""
-        buffer = QBuffer()
-        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
-        qp = QImage(":/images/themes/default/mIconWarning.svg")
-        qp.save(buffer, "PNG")
-        return bytes(buffer.data().toBase64().data()).decode()
+        if cls._warning_icon is None:
+            buffer = QBuffer()
+            buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+            qp = QImage(":/images/themes/default/mIconWarning.svg")
+            qp.save(buffer, "PNG")
+            cls._warning_icon = bytes(buffer.data().toBase64().data()).decode()
+        return cls._warning_icon
+
+    @classmethod
+    def invalid_layer_legend(cls, layer_name: str) -> bytes:
+        """The legend of an invalid layer, with the warning icon."""
+        body = _invalid_legend_cache.get(layer_name)
+        if body is None:
+            json_data = {
+                "title": "",
+                "nodes": [
+                    {
+                        "type": "layer",
+                        "title": layer_name,
+                        "icon": cls.warning_icon(),
+                        "valid": False,
+                    }
+                ],
+            }
+            body = json.dumps(json_data).encode("utf8")
+            _invalid_legend_cache.set(layer_name, body)
+        return body
 
     def responseComplete(self) -> None:
         handler = _N(self.serverInterface()).requestHandler()
@@ -98,42 +145,32 @@ class GetLegendGraphicFilter(QgsServerFilter):
                 f"Layer '{layer_name}' is not valid, returning a warning icon in the legend for project "
                 f"'{project.homePath()}'",
             )
-            json_data = {
-                "title": "",
-                "nodes": [
-                    {
-                        "type": "layer",
-                        "title": layer_name,
-                        "icon": self.warning_icon(),
-                        "valid": False,
-                    }
-                ],
-            }
             handler.clearBody()
-            handler.appendBody(json.dumps(json_data).encode("utf8"))
+            handler.appendBody(self.invalid_layer_legend(layer_name))
             return
 
         if layer.type() != Qgis.LayerType.Vector:
             logger.info(f"Skipping the layer '{layer_name}' because it's not a vector layer")
             return
 
+        switch_style = False
+        legend_style = ""
         try:
             layer = cast("QgsVectorLayer", layer)
             current_style = _N(layer.styleManager()).currentStyle()
 
             if current_style and style and style != current_style:
-                _N(layer.styleManager()).setCurrentStyle(style)
-
-            # Force count symbol features
-            # It seems that in QGIS Server 3.22 countSymbolFeatures is not used for JSON
-            if show_feature_count:
-                counter = layer.countSymbolFeatures()
-                if counter:
-                    counter.waitForFinished()
+                # The features are counted with the renderer of the layer,
+                # otherwise the renderer of the style is used without changing the current style
+                switch_style = show_feature_count or self._style_renderer(layer, style) is None
+                if switch_style:
+                    _N(layer.styleManager()).setCurrentStyle(style)
+                else:
+                    legend_style = style
 
             # From QGIS source code :
             # https://github.com/qgis/QGIS/blob/71499aacf431d3ac244c9b75c3d345bdc53572fb/src/core/symbology/qgsrendererregistry.cpp#L33
-            renderer = layer.renderer()
+            renderer = self._style_renderer(layer, legend_style)
             if renderer is not None and renderer.type() in (
                 "categorizedSymbol",
                 "RuleRenderer",
@@ -152,6 +189,7 @@ class GetLegendGraphicFilter(QgsServerFilter):
                     layer,
                     show_feature_count,
                     project.homePath(),
+                    legend_style,
                 )
 
                 for idx in range(len(symbols)):
@@ -196,53 +234,175 @@ class GetLegendGraphicFilter(QgsServerFilter):
             # Let QGIS server handle error 500
             raise
         finally:
-            if layer is not None and style and current_style and style != current_style:
+            if layer is not None and switch_style:
                 _N(layer.styleManager()).setCurrentStyle(current_style)
 
+    @classmethod
+    def _style_renderer(cls, layer: QgsVectorLayer, style: str = "") -> Optional[QgsFeatureRenderer]:
+        """The renderer of the layer for the style, without changing the current style of the layer.
+
+        The renderer of a style which is not the current one is read once from the style.
+        """
+        style_manager = _N(layer.styleManager())
+        if not style or style == style_manager.currentStyle():
+            return layer.renderer()
+
+        project = layer.project()
+        key = (
+            project.fileName() if project else "",
+            project.lastModified().toMSecsSinceEpoch() if project else 0,
+            layer.id(),
+            style,
+        )
+        renderer = _renderer_cache.get(key)
+        if renderer is not None:
+            return renderer
+
+        if style not in style_manager.styles():
+            return None
+
+        dom_doc = QDomDocument("qgis")
+        dom_doc.setContent(style_manager.style(style).xmlData())
+        renderer_elem = dom_doc.documentElement().firstChildElement("renderer-v2")
+        if renderer_elem.isNull():
+            return None
+
+        context = QgsReadWriteContext()
+        if project:
+            context.setPathResolver(project.pathResolver())
+        renderer = QgsFeatureRenderer.load(renderer_elem, context)
+        if renderer is None:
+            return None
+
+        _renderer_cache.set(key, renderer)
+        return renderer
+
+    @classmethod
+    def _legend_categories(
+        cls,
+        layer: QgsVectorLayer,
+        project_path: str = "",
+        style: str = "",
+    ) -> Tuple[Category, ...]:
+        """The categories of the layer legend, without the check state and the feature count.
+
+        The categories are cached by project, layer, style and renderer type.
+        The project is reloaded by QGIS Server when its file is modified, so are the renderers.
+        """
+        renderer = _N(cls._style_renderer(layer, style))
+        project = layer.project()
+        key = (
+            project.fileName() if project else "",
+            project.lastModified().toMSecsSinceEpoch() if project else 0,
+            layer.id(),
+            style or _N(layer.styleManager()).currentStyle(),
+            renderer.type(),
+        )
+        categories = _legend_cache.get(key)
+        if categories is not None:
+            return categories
+
+        items = []
+        for item in renderer.legendSymbolItems():
+            expression, result = renderer.legendKeyToExpression(item.ruleKey(), layer)
+            if not result:
+                logger.warning(
+                    f"The expression in the project '{project_path}', layer '{layer.name()}' has not "
+                    f"been generated correctly, setting the expression to an empty string",
+                )
+                expression = ""
+
+            items.append(
+                Category(
+                    ruleKey=item.ruleKey(),
+                    checked=None,
+                    parentRuleKey=item.parentRuleKey(),
+                    scaleMaxDenom=item.scaleMaxDenom(),
+                    scaleMinDenom=item.scaleMinDenom(),
+                    expression=expression,
+                    title=item.label(),
+                )
+            )
+
+        categories = tuple(items)
+        _legend_cache.set(key, categories)
+        return categories
+
+    @classmethod
+    def _feature_counts(cls, layer: QgsVectorLayer) -> Dict[str, int]:
+        """The number of features by legend key, counted in a single pass on the layer.
+
+        The counts are cached by project, layer, style and subset string, the subset string
+        holding the filters of the request. When they are kept between requests, an edition
+        of the data is seen after the TTL.
+        """
+        renderer = _N(layer.renderer())
+        project = layer.project()
+        key = (
+            project.fileName() if project else "",
+            project.lastModified().toMSecsSinceEpoch() if project else 0,
+            layer.id(),
+            _N(layer.styleManager()).currentStyle(),
+            renderer.type(),
+            layer.subsetString(),
+        )
+        counts = _feature_count_cache.get(key)
+        if counts is not None:
+            return counts
+
+        # Force count symbol features
+        # It seems that in QGIS Server 3.22 countSymbolFeatures is not used for JSON
+        counter = layer.countSymbolFeatures()
+        if counter:
+            counter.waitForFinished()
+
+        counts = {
+            category.ruleKey: layer.featureCount(category.ruleKey)
+            for category in cls._legend_categories(layer)
+        }
+        _feature_count_cache.set(key, counts)
+        return counts
+
     @classmethod
     def _extract_categories(
         cls,
         layer: QgsVectorLayer,
         show_feature_count: bool = False,
         project_path: str = "",
+        style: str = "",
     ) -> dict:
-        """Extract categories from the layer legend."""
+        """Extract categories from the layer legend, for the style if it is not the current one.
+
+        The features are counted with the current style of the layer.
+        """
         # TODO Annotations QGIS 3.22 [str, Category]
-        renderer = _N(layer.renderer())
+        renderer = _N(cls._style_renderer(layer, style))
+        counts = {}
+        estimated_count = False
+        if show_feature_count:
+            counts = cls._feature_counts(layer)
+            estimated_count = _N(layer.dataProvider()).uri().useEstimatedMetadata()
+
         categories: dict = {}
-        for item in renderer.legendSymbolItems():
+        for category in cls._legend_categories(layer, project_path, style):
             # Calculate title if show_feature_count is activated
-            # It seems that in QGIS Server 3.22 countSymbolFeatures is not used for JSON
-            title = item.label()
+            label = category.title
+            title = label
             if show_feature_count:
-                estimated_count = _N(layer.dataProvider()).uri().useEstimatedMetadata()
-                count = layer.featureCount(item.ruleKey())
+                count = counts.get(category.ruleKey, -1)
                 title += " [{}{}]".format(
                     "≈" if estimated_count else "",
                     count if count != -1 else "N/A",
                 )
 
-            expression, result = renderer.legendKeyToExpression(item.ruleKey(), layer)
-            if not result:
-                logger.warning(
-                    f"The expression in the project '{project_path}', layer '{layer.name()}' has not "
-                    f"been generated correctly, setting the expression to an empty string",
-                )
-                expression = ""
-
-            if item.label() in categories:
+            if label in categories:
                 logger.warning(
-                    f"The label key '{item.label()}' is not unique, expect the legend to be broken in the project "
+                    f"The label key '{label}' is not unique, expect the legend to be broken in the project "
                     f"'{project_path}', layer '{layer.name()}'.",
                 )
 
-            categories[item.label()] = Category(
-                ruleKey=item.ruleKey(),
-                checked=renderer.legendSymbolItemChecked(item.ruleKey()),
-                parentRuleKey=item.parentRuleKey(),
-                scaleMaxDenom=item.scaleMaxDenom(),
-                scaleMinDenom=item.scaleMinDenom(),
-                expression=expression,
+            categories[label] = category._replace(
+                checked=renderer.legendSymbolItemChecked(category.ruleKey),
                 title=title,
             )
         return categories
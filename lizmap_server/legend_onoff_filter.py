@@ -8,7 +8,10 @@
 import traceback
 
 from typing import (
+    Dict,
     Optional,
+    Set,
+    Tuple,
 )
 
 from qgis.core import (
@@ -22,44 +25,55 @@ from qgis.server import (
     QgsServerInterface,
 )
 
-from .core import find_vector_layer
+from .core import find_vector_layer, register_request_cache
 from .tools import _N
 
 from . import logger
 
 
+# Rule keys by layer name, short name or ID
+LegendKeys = Dict[str, Set[str]]
+
+
+def parse_legend_parameter(qs: str) -> LegendKeys:
+    """Parse LEGEND_ON or LEGEND_OFF into rule keys by layer name, short name or ID."""
+    legend: LegendKeys = {}
+    if not qs:
+        return legend
+
+    for legend_layer in qs.split(";"):
+        layer_name, key_list = legend_layer.split(":")
+        # not empty
+        if layer_name == "" or key_list == "":
+            continue
+        legend.setdefault(layer_name, set()).update(key_list.split(","))
+    return legend
+
+
 class LegendOnOffAccessControl(QgsAccessControlFilter):
     def __init__(self, server_interface: QgsServerInterface):
         super().__init__(server_interface)
 
         self.iface = server_interface
 
-    @staticmethod
-    def _setup_legend(layer: QgsMapLayer, qs: str, onoff: bool):
-
-        if Qgis.versionInt() < 33800:
-            layer_short_name = layer.shortName()
-        else:
-            layer_short_name = _N(layer.serverProperties()).shortName()
-
-        for legend_layer in qs.split(";"):
-            layer_name, key_list = legend_layer.split(":")
-            # not empty
-            if layer_name == "" or key_list == "":
-                continue
-            # for the layer
-            if layer_name not in (layer_short_name, layer.name(), layer.id()):
-                continue
-
-            # TODO: check that layer is a vector layer
-            for key in key_list.split(","):
-                layer.renderer().checkLegendSymbolItem(key, onoff)  # ty: ignore[unresolved-attribute]
+        # Request scoped memo
+        # The styles by layer and the rule keys of LEGEND_ON and LEGEND_OFF by layer
+        self._request_legend: Optional[Tuple[Dict[str, str], Optional[LegendKeys], Optional[LegendKeys]]] = (
+            None
+        )
+        register_request_cache(self._clear_request_memo)
 
-    def layerPermissions(self, layer: Optional[QgsMapLayer]) -> QgsAccessControlFilter.LayerPermissions:
+    def _clear_request_memo(self):
+        """Reset the parameters parsed for the previous request."""
+        self._request_legend = None
 
-        layer = _N(layer)
+    def _get_request_legend(self) -> Tuple[Dict[str, str], Optional[LegendKeys], Optional[LegendKeys]]:
+        """Get the styles and the LEGEND_ON and LEGEND_OFF rule keys by layer, parsed once per request.
 
-        rights = super().layerPermissions(layer)
+        The rule keys are None if the parameter is not in the request.
+        """
+        if self._request_legend is not None:
+            return self._request_legend
 
         handler = _N(self.iface.requestHandler())
         params = handler.parameterMap()
@@ -82,6 +96,43 @@ class LegendOnOffAccessControl(QgsAccessControlFilter):
         except Exception:
             style_map = {}
 
+        self._request_legend = (
+            style_map,
+            parse_legend_parameter(params["LEGEND_ON"]) if "LEGEND_ON" in params else None,
+            parse_legend_parameter(params["LEGEND_OFF"]) if "LEGEND_OFF" in params else None,
+        )
+        return self._request_legend
+
+    @staticmethod
+    def _setup_legend(layer: QgsMapLayer, legend: LegendKeys, onoff: bool):
+
+        if Qgis.versionInt() < 33800:
+            layer_short_name = layer.shortName()
+        else:
+            layer_short_name = _N(layer.serverProperties()).shortName()
+
+        keys = set()
+        # for the layer
+        for layer_name in {layer_short_name, layer.name(), layer.id()}:
+            keys.update(legend.get(layer_name, ()))
+        if not keys:
+            return
+
+        # TODO: check that layer is a vector layer
+        renderer = layer.renderer()  # ty: ignore[unresolved-attribute]
+        for key in keys:
+            # Only the keys changing state
+            if renderer.legendSymbolItemChecked(key) != onoff:
+                renderer.checkLegendSymbolItem(key, onoff)
+
+    def layerPermissions(self, layer: Optional[QgsMapLayer]) -> QgsAccessControlFilter.LayerPermissions:
+
+        layer = _N(layer)
+
+        rights = super().layerPermissions(layer)
+
+        style_map, legend_on, legend_off = self._get_request_legend()
+
         sm = _N(layer.styleManager())
         style = sm.currentStyle()
 
@@ -102,14 +153,14 @@ class LegendOnOffAccessControl(QgsAccessControlFilter):
 
         sm.setCurrentStyle(style)
 
-        if "LEGEND_ON" in params:
-            self._setup_legend(layer, params["LEGEND_ON"], True)
-        if "LEGEND_OFF" in params:
-            self._setup_legend(layer, params["LEGEND_OFF"], False)
+        if legend_on is not None:
+            self._setup_legend(layer, legend_on, True)
+        if legend_off is not None:
+            self._setup_legend(layer, legend_off, False)
 
         if (
-            "LEGEND_ON" not in params
-            and "LEGEND_OFF" not in params
+            legend_on is None
+            and legend_off is None
             and layer.type() == Qgis.LayerType.Vector
             and layer.renderer()  # ty: ignore[unresolved-attribute]
             and layer.renderer().type()  # ty: ignore[unresolved-attribute]
@@ -121,7 +172,8 @@ class LegendOnOffAccessControl(QgsAccessControlFilter):
         ):
             renderer = layer.renderer()  # ty: ignore[unresolved-attribute]
             for item in renderer.legendSymbolItems():
-                renderer.checkLegendSymbolItem(item.ruleKey(), True)
+                if not renderer.legendSymbolItemChecked(item.ruleKey()):
+                    renderer.checkLegendSymbolItem(item.ruleKey(), True)
 
         return rights
 
@@ -142,15 +194,7 @@ class LegendOnOffFilter(QgsServerFilter):
         if not qs or ":" not in qs:
             return
 
-        for legend_layer in qs.split(";"):
-            layer_name, key_list = legend_layer.split(":")
-            if layer_name == "" or key_list == "":
-                continue
-
-            keys = key_list.split(",")
-            if len(keys) == 0:
-                continue
-
+        for layer_name, keys in parse_legend_parameter(qs).items():
             layer = find_vector_layer(layer_name, project)
             if layer is None:
                 logger.warning(
@@ -1,18 +1,20 @@
 from typing import (
+    Dict,
     Optional,
+    Tuple,
 )
 
 from qgis.core import QgsExpression, QgsMapLayer, QgsProject, QgsVectorLayer
 from qgis.server import QgsAccessControlFilter, QgsServerInterface
 
 from .core import (
-    get_lizmap_config,
+    LizmapConfigView,
+    get_lizmap_config_view,
     get_lizmap_groups,
-    get_lizmap_layer_login_filter,
-    get_lizmap_layers_config,
     get_lizmap_override_filter,
     get_lizmap_user_login,
     is_editing_context,
+    register_request_cache,
 )
 from .filter_by_polygon import (
     ALL_FEATURES,
@@ -41,6 +43,28 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
         logger.info(f"LayerAccessControl : Google {self._strict_google}, Bing {self._strict_bing}")
 
+        # Request scoped memo
+        # The user groups and login provided by the request
+        self._request_user: Optional[Tuple[Tuple[str, ...], str]] = None
+        # The rights (read, insert, update, delete) by (layer ID, groups, login, config last modified)
+        self._permissions: Dict[tuple, Tuple[bool, bool, bool, bool]] = {}
+        register_request_cache(self._clear_request_memo)
+
+    def _clear_request_memo(self):
+        """Reset the decisions made for the previous request."""
+        self._request_user = None
+        self._permissions.clear()
+
+    def _get_request_user(self) -> Tuple[Tuple[str, ...], str]:
+        """Get Lizmap user groups and login provided by the request, once per request."""
+        if self._request_user is None:
+            request_handler = _N(self.iface.requestHandler())
+            self._request_user = (
+                get_lizmap_groups(request_handler),
+                get_lizmap_user_login(request_handler),
+            )
+        return self._request_user
+
     def layerFilterSubsetString(self, layer: Optional[QgsVectorLayer]) -> str:
         """Return an additional subset string (typically SQL) filter"""
         logger.info("Lizmap layerFilterSubsetString")
@@ -59,6 +83,32 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         # Get default layer rights
         rights = super().layerPermissions(layer)
 
+        # Get Lizmap user groups and login provided by the request
+        groups, user_login = self._get_request_user()
+
+        # Get Lizmap config
+        cfg = get_lizmap_config_view(self.iface.configFilePath())
+
+        # QGIS Server asks many times for the same layer during a request
+        key = (layer.id(), groups, user_login, cfg.last_modified if cfg else None)
+        permissions = self._permissions.get(key)
+        if permissions is not None:
+            rights.canRead, rights.canInsert, rights.canUpdate, rights.canDelete = permissions
+            return rights
+
+        rights = self._layer_permissions(layer, rights, groups, user_login, cfg)
+        self._permissions[key] = (rights.canRead, rights.canInsert, rights.canUpdate, rights.canDelete)
+        return rights
+
+    def _layer_permissions(
+        self,
+        layer: QgsMapLayer,
+        rights: QgsAccessControlFilter.LayerPermissions,
+        groups: Tuple[str, ...],
+        user_login: str,
+        cfg: Optional[LizmapConfigView],
+    ) -> QgsAccessControlFilter.LayerPermissions:
+        """Compute the layer rights for the Lizmap user groups and login"""
         # Get Project
         project = _N(QgsProject.instance())
 
@@ -74,11 +124,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             rights.canRead = rights.canInsert = rights.canUpdate = rights.canDelete = False
             return rights
 
-        # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(request_handler)
-
         # Set lizmap variables
-        user_login = get_lizmap_user_login(request_handler)
         custom_var = project.customVariables()
         if custom_var.get("lizmap_user", None) != user_login:
             custom_var["lizmap_user"] = user_login
@@ -99,8 +145,6 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
                 f"Layer '{layer_name}' has been detected as an external layer which might need a API key."
             )
 
-        # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
         if not cfg:
             if is_google:
                 rights.canRead = rights.canInsert = rights.canUpdate = (
@@ -118,7 +162,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         if len(groups) == 0 and not (is_google or is_bing):
             return rights
 
-        api_key = cfg["options"].get("googleKey", "")
+        api_key = cfg.options.get("googleKey", "")
         if is_google and not api_key and strict_tos_check(GOOGLE_KEY):
             rights.canRead = rights.canInsert = rights.canUpdate = rights.canDelete = False
             logger.warning(
@@ -127,7 +171,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             )
             return rights
 
-        api_key = cfg["options"].get("bingKey", "")
+        api_key = cfg.options.get("bingKey", "")
         if is_bing and not api_key and strict_tos_check(BING_KEY):
             rights.canRead = rights.canInsert = rights.canUpdate = rights.canDelete = False
             logger.warning(
@@ -137,33 +181,26 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return rights
 
         # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
+        cfg_layers = cfg.layers
         if not cfg_layers:
             # Default layer rights applied
             return rights
 
         # Check lizmap edition config
         layer_id = layer.id()
-        if cfg.get("editionLayers"):
-            if layer_id in cfg["editionLayers"] and cfg["editionLayers"][layer_id]:
-                edit_layer = cfg["editionLayers"][layer_id]
+        if cfg.edition_layers:
+            if cfg.edition_layers.get(layer_id):
+                edit_layer = cfg.edition_layers[layer_id]
 
                 # Check if edition is possible
                 # By default not
                 can_edit = False
-                if edit_layer.get("acl"):
+                group_edit = cfg.edition_acl.get(layer_id)
+                if group_edit is not None:
                     # acl is defined and not an empty string
                     # authorization defined for edition
-                    group_edit = edit_layer["acl"].split(",")
-                    group_edit = [g.strip() for g in group_edit]
-
                     # check if a group is in authorization groups list
-                    if len(group_edit) != 0:
-                        for g in groups:
-                            if g in group_edit:
-                                can_edit = True
-                    else:
-                        can_edit = True
+                    can_edit = not group_edit.isdisjoint(groups)
                 else:
                     # acl is not defined or an empty string
                     # no authorization defined for edition
@@ -172,7 +209,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
                 if can_edit and "capabilities" in edit_layer and edit_layer["capabilities"]:
                     # A user group can edit the layer and capabilities
                     # edition for the layer is defined in Lizmap edition config
-                    edit_layer_cap = cfg["editionLayers"][layer_id]["capabilities"]
+                    edit_layer_cap = edit_layer["capabilities"]
 
                     rights.canInsert = to_bool(edit_layer_cap["createFeature"])
                     rights.canDelete = to_bool(edit_layer_cap["deleteFeature"])
@@ -208,23 +245,20 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return rights
 
         # Check Lizmap layer group visibility
-        cfg_layer = cfg_layers[layer_name]
-        if "group_visibility" not in cfg_layer or not cfg_layer["group_visibility"]:
+        # Get cleaned Lizmap layer group visibility
+        group_visibility = cfg.group_visibility.get(layer_name)
+        if group_visibility is None:
             # Lizmap config has no options
             logger.info(f"No Lizmap layer group visibility for: {layer_name}")
             # Default layer rights applied
             return rights
 
-        # Get Lizmap layer group visibility
-        group_visibility = [g.strip() for g in cfg_layer["group_visibility"]]
-
         # If one Lizmap user group provided in request headers is
         # defined in Lizmap layer group visibility, the default layer
         # rights is applied
-        for g in groups:
-            if g in group_visibility:
-                logger.info(f"Group {g} is in Lizmap layer group visibility for: {layer_name}")
-                return rights
+        if layer_name in cfg.visible_layers(groups):
+            logger.info(f"Groups {', '.join(groups)} is in Lizmap layer group visibility for: {layer_name}")
+            return rights
 
         # The lizmap user groups provided gy the request are not
         # authorized to get access to the layer
@@ -238,7 +272,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         default_cache_key = super().cacheKey()
 
         # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(_N(self.iface.requestHandler()))
+        groups, _ = self._get_request_user()
 
         # If groups is empty, no Lizmap user groups provided by the request
         # The default cache key is returned
@@ -246,33 +280,21 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return default_cache_key
 
         # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
+        cfg = get_lizmap_config_view(self.iface.configFilePath())
         if not cfg:
             # The default cache key is returned
             return default_cache_key
 
         # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
-        if not cfg_layers:
+        if not cfg.layers:
             # The default cache key is returned
             return default_cache_key
 
         # Check group_visibility in Lizmap config layers
-        has_group_visibility = False
-        for l_name, cfg_layer in cfg_layers.items():
-            # check group_visibility in config
-            if "group_visibility" not in cfg_layer or not cfg_layer["group_visibility"]:
-                continue
-
-            # clean group_visibility
-            group_visibility = [g.strip() for g in cfg_layer["group_visibility"]]
-
-            # the group_visibility was just an empty string
-            if len(group_visibility) == 1 and groups[0] == "":
-                continue
-
-            has_group_visibility = True
-            break
+        # the group_visibility with a single group is skipped for the anonymous group
+        has_group_visibility = cfg.max_group_visibility_size > 1 or (
+            cfg.max_group_visibility_size == 1 and groups[0] != ""
+        )
 
         # group_visibility option is defined in Lizmap config layers
         if has_group_visibility:
@@ -296,8 +318,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             return ALL_FEATURES
 
         # Get Lizmap user groups provided by the request
-        groups = get_lizmap_groups(request_handler)
-        user_login = get_lizmap_user_login(request_handler)
+        groups, user_login = self._get_request_user()
 
         # If groups is empty, no Lizmap user groups provided by the request
         if len(groups) == 0 and not user_login:
@@ -305,12 +326,12 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
 
         # If headers content implies to check for filter, read the Lizmap config
         # Get Lizmap config
-        cfg = get_lizmap_config(self.iface.configFilePath())
+        cfg = get_lizmap_config_view(self.iface.configFilePath())
         if not cfg:
             return ALL_FEATURES
 
         # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
+        cfg_layers = cfg.layers
         if not cfg_layers:
             return ALL_FEATURES
 
@@ -323,7 +344,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
         try:
             edition_context = is_editing_context(_N(self.iface.requestHandler()))
             filter_polygon_config = FilterByPolygon(
-                cfg.get("filter_by_polygon"),
+                cfg.cfg.get("filter_by_polygon"),
                 layer,
                 edition_context,
                 filter_type=filter_type,
@@ -357,7 +378,7 @@ class LizmapAccessControlFilter(QgsAccessControlFilter):
             logger.info(f"The polygon filter subset string is not null : {polygon_filter}")
 
         # Get layer login filter
-        cfg_layer_login_filter = get_lizmap_layer_login_filter(cfg, layer_name)
+        cfg_layer_login_filter = cfg.login_filter(layer_name)
         if not cfg_layer_login_filter:
             if polygon_filter:
                 return polygon_filter
@@ -1,7 +1,7 @@
 from qgis.core import QgsProject
 from qgis.server import QgsServerFilter, QgsServerInterface
 
-from .core import get_lizmap_config, get_lizmap_groups
+from .core import clear_request_caches, get_lizmap_config_view, get_lizmap_groups
 from .exception import LizmapFilterException
 from .tools import _N
 from . import logger
@@ -15,6 +15,10 @@ class LizmapFilter(QgsServerFilter):
         self.iface = server_iface
 
     def requestReady(self):
+        # A new request, caches from the previous request are not valid anymore
+        # This filter is registered with the lowest priority number, it runs before the other filters
+        clear_request_caches()
+
         # noinspection PyBroadException
         try:
             # Check first the headers to avoid unnecessary config file reading
@@ -27,14 +31,14 @@ class LizmapFilter(QgsServerFilter):
                 return
 
             # Get Lizmap config
-            cfg = get_lizmap_config(self.iface.configFilePath())
+            cfg = get_lizmap_config_view(self.iface.configFilePath())
             if not cfg:
                 # Lizmap config is empty
                 logger.warning("Lizmap config is empty")
                 # The request can be evaluated by QGIS Server
                 return
 
-            cfg_options = cfg.get("options")
+            cfg_options = cfg.options
             # Check Lizmap config options
             if not cfg_options:
                 # Lizmap config has no options
@@ -74,6 +78,9 @@ class LizmapFilter(QgsServerFilter):
             logger.log_exception(e)
 
     def responseComplete(self):
+        # The request scoped caches are kept, the filters registered after this one still use them
+        # They are cleared when the next request is ready
+
         # Remove lizmap variables for expression
         project = _N(QgsProject.instance())
         custom_var = project.customVariables()
@@ -3,10 +3,11 @@ import traceback
 from typing import (
     Dict,
     Optional,
+    Tuple,
 )
 
 from osgeo import gdal
-from qgis.core import Qgis, QgsProject
+from qgis.core import Qgis, QgsProject, QgsVectorLayer
 from qgis.server import (
     QgsServerInterface,
     QgsServerRequest,
@@ -15,10 +16,10 @@ from qgis.server import (
 )
 
 from .core import (
+    find_vector_layer,
     find_vector_layer_from_params,
-    get_lizmap_config,
+    get_lizmap_config_view,
     get_lizmap_groups,
-    get_lizmap_layers_config,
     get_lizmap_override_filter,
     get_lizmap_user_login,
     is_editing_context,
@@ -109,44 +110,88 @@ class LizmapService(QgsService):
         response: QgsServerResponse,
         project: QgsProject,
     ) -> None:
-        """The subset string to use a on a layer."""
+        """The subset string to use a on a layer.
+
+        With the LAYERS parameter, the subset strings of many layers are returned at once.
+        """
+        layer_names = params.get("LAYERS", params.get("layers", ""))
+        if layer_names:
+            self.polygon_filters(layer_names, params, response, project)
+            return
+
         layer = find_vector_layer_from_params(params, project)
         if layer is None:
-            raise ServiceError("Bad request error", "Invalid LAYER parameter", 400)
+            raise LizmapServiceError("Bad request error", "Invalid LAYER parameter", 400)
 
+        sql, polygons = self._layer_polygon_filter(layer, params)
         body = {
             "status": "success",
-            "filter": ALL_FEATURES,
-            "polygons": "",
+            "filter": sql,
+            "polygons": polygons,
         }
+        write_json_response(body, response)
 
+    @logger.profiling
+    def polygon_filters(
+        self,
+        layer_names: str,
+        params: Dict[str, str],
+        response: QgsServerResponse,
+        project: QgsProject,
+    ) -> None:
+        """The subset strings to use on many layers, separated by a comma.
+
+        The polygons for the groups or the user are shared by all layers.
+        """
+        layers = {}
+        for layer_name in layer_names.split(","):
+            layer_name = layer_name.strip()
+            if not layer_name:
+                continue
+            layer = find_vector_layer(layer_name, project)
+            if layer is None:
+                raise LizmapServiceError(
+                    "Bad request error", f"Invalid LAYERS parameter, {layer_name} not found", 400
+                )
+            layers[layer_name] = layer
+
+        body: dict = {
+            "status": "success",
+            "layers": {},
+        }
+        for layer_name, layer in layers.items():
+            sql, polygons = self._layer_polygon_filter(layer, params)
+            body["layers"][layer_name] = {
+                "filter": sql,
+                "polygons": polygons,
+            }
+        write_json_response(body, response)
+
+    def _layer_polygon_filter(self, layer: QgsVectorLayer, params: Dict[str, str]) -> Tuple[str, str]:
+        """The subset string and the polygons to use on a layer."""
         request_handler = _N(self.server_iface.requestHandler())
 
         # Check first the headers to avoid unnecessary config file reading
         # Override filter
         if get_lizmap_override_filter(request_handler):
-            write_json_response(body, response)
-            return
+            return ALL_FEATURES, ""
 
         # If headers content implies to check for filter, read the Lizmap config
         # Get Lizmap config
-        cfg = get_lizmap_config(self.server_iface.configFilePath())
+        cfg = get_lizmap_config_view(self.server_iface.configFilePath())
         if not cfg:
-            write_json_response(body, response)
-            return
+            return ALL_FEATURES, ""
 
         # Get layers config
-        cfg_layers = get_lizmap_layers_config(cfg)
+        cfg_layers = cfg.layers
         if not cfg_layers:
-            write_json_response(body, response)
-            return
+            return ALL_FEATURES, ""
 
         # Get layer name
         layer_name = layer.name()
         # Check the layer in the CFG
         if layer_name not in cfg_layers:
-            write_json_response(body, response)
-            return
+            return ALL_FEATURES, ""
 
         try:
             filter_type_param = params.get("FILTER_TYPE", "").upper()
@@ -161,55 +206,40 @@ class LizmapService(QgsService):
 
             edition_context = is_editing_context(request_handler)
             filter_polygon_config = FilterByPolygon(
-                cfg.get("filter_by_polygon"),
+                cfg.cfg.get("filter_by_polygon"),
                 layer,
                 edition_context,
                 filter_type=filter_type,
             )
-            if filter_polygon_config.is_filtered():
-                if not filter_polygon_config.is_valid():
-                    logger.critical(
-                        "The filter by polygon configuration is not valid.\n All features are hidden."
-                    )
-                    body = {
-                        "status": "success",
-                        "filter": NO_FEATURES,
-                        "polygons": "",
-                    }
-                    write_json_response(body, response)
-                    return
-
-                # Get Lizmap user groups provided by the request
-                groups = get_lizmap_groups(request_handler)
-
-                # polygon_filter is set, we have a value to filter
-                # pass the tuple of groups or the tuple of the user
-                # depending on the filter_by_user boolean variable
-                groups_or_user = groups
-                if filter_polygon_config.is_filtered_by_user():
-                    user_login = get_lizmap_user_login(request_handler)
-                    groups_or_user = (user_login,)
-
-                # Get the subset SQL
-                sql, polygons = filter_polygon_config.subset_sql(groups_or_user)
-                body = {
-                    "status": "success",
-                    "filter": sql,
-                    "polygons": polygons,
-                }
-                write_json_response(body, response)
+            if not filter_polygon_config.is_filtered():
+                return ALL_FEATURES, ""
+
+            if not filter_polygon_config.is_valid():
+                logger.critical(
+                    "The filter by polygon configuration is not valid.\n All features are hidden."
+                )
+                return NO_FEATURES, ""
+
+            # Get Lizmap user groups provided by the request
+            groups = get_lizmap_groups(request_handler)
+
+            # polygon_filter is set, we have a value to filter
+            # pass the tuple of groups or the tuple of the user
+            # depending on the filter_by_user boolean variable
+            groups_or_user = groups
+            if filter_polygon_config.is_filtered_by_user():
+                user_login = get_lizmap_user_login(request_handler)
+                groups_or_user = (user_login,)
+
+            # Get the subset SQL
+            return filter_polygon_config.subset_sql(groups_or_user)
 
         except Exception as e:
             logger.log_exception(e)
             logger.critical(
                 "An error occurred when trying to read the filtering by polygon.\nAll features are hidden."
             )
-            body = {
-                "status": "success",
-                "filter": NO_FEATURES,
-                "polygons": "",
-            }
-            write_json_response(body, response)
+            return NO_FEATURES, ""
 
     def get_server_settings(
         self, params: Dict[str, str], response: QgsServerResponse, project: QgsProject
@@ -1,10 +1,13 @@
 import configparser
 import functools
 import os
+import threading
+import time
 
+from collections import OrderedDict
 from importlib import resources
 from pathlib import Path
-from typing import Optional, Union, TypeVar, cast
+from typing import Any, Callable, Hashable, Optional, Union, TypeVar, cast
 
 
 from . import logger
@@ -42,6 +45,74 @@ def version() -> str:
     return plugin_metadata()["general"]["version"]
 
 
+def env_float(key: str, default: float) -> float:
+    """Read a number from an environment variable, the default value if not set or invalid."""
+    value = os.getenv(key, "")
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning(f"Invalid value '{value}' for the environment variable {key}")
+        return default
+
+
+class TTLCache:
+    """Bounded LRU cache, entries expire after `ttl` seconds.
+
+    If `ttl` is lower or equal to 0, entries are only kept during the current
+    request, see `new_request`.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Get the value for the key, the default value if missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            created, value = entry
+            if self.ttl > 0 and time.monotonic() - created >= self.ttl:
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        """Set the value for the key, the least recently used entries are removed."""
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, predicate: Callable[[Any], bool]):
+        """Remove entries having a key matching the predicate."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        """Remove all entries."""
+        with self._lock:
+            self._entries.clear()
+
+    def new_request(self):
+        """Remove all entries if they must be kept only during a request."""
+        if self.ttl <= 0:
+            self.clear()
+
+
 def check_environment_variable() -> bool:
     """Check the server configuration."""
     lizmap_enabled = to_bool(os.environ.get("QGIS_SERVER_LIZMAP_REVEAL_SETTINGS", ""))
@@ -1,3 +1,6 @@
+from qgis.core import QgsProject, QgsVectorLayer
+
+from lizmap_server.expression_service.expression_cache import _expression_cache, parsed_expression
 from tests.utils import _build_query_string, _check_request
 
 
@@ -19,3 +22,28 @@ def test_request_unknown(client):
 
     assert "code" in b
     assert "message" in b
+
+
+def test_parsed_expression_cache():
+    """Test the expressions are parsed once, the copies are prepared independently"""
+    project = QgsProject()
+    layer = QgsVectorLayer("Point?field=name:string", "points", "memory")
+
+    _expression_cache.clear()
+    parsed = parsed_expression('upper("name") || @layer_name', layer, project)
+    assert parsed is parsed_expression('upper("name") || @layer_name', layer, project)
+    assert len(_expression_cache) == 1
+    assert not parsed.expression.hasParserError()
+    assert parsed.referenced_columns == frozenset(("name",))
+    assert "upper" in parsed.referenced_functions
+
+    expression = parsed.copy()
+    assert expression is not parsed.expression
+    assert expression.expression() == parsed.expression.expression()
+
+    # The parser error is kept
+    parsed = parsed_expression('upper("name"', layer, project)
+    assert parsed.expression.hasParserError()
+    assert parsed.copy().hasParserError()
+    assert len(_expression_cache) == 2
+    _expression_cache.clear()
@@ -0,0 +1,110 @@
+"""Test expression templates."""
+
+import unittest
+
+from qgis.core import (
+    Qgis,
+    QgsDistanceArea,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsGeometry,
+    QgsProject,
+    QgsVectorLayer,
+)
+
+from lizmap_server.expression_template import ExpressionTemplate, _template_cache, expression_template
+
+
+class TestExpressionTemplate(unittest.TestCase):
+    def test_render_as_replace_expression_text(self):
+        """Test the template renders the same text as QgsExpression.replaceExpressionText."""
+        layer = QgsVectorLayer(
+            "Polygon?crs=epsg:2154&field=name:string&field=value:double&field=empty:integer",
+            "polygons",
+            "memory",
+        )
+        context = QgsExpressionContext()
+        context.appendScope(QgsExpressionContextUtils.globalScope())
+        context.appendScope(QgsExpressionContextUtils.layerScope(layer))
+
+        distance_area = QgsDistanceArea()
+        distance_area.setSourceCrs(layer.crs(), layer.transformContext())
+
+        texts = (
+            "No expression",
+            '<p>[% "name" %]</p>',
+            '[%"value" * 2%] and [% "empty" %] and [% "value" > 1 %]',
+            "<b>[% $area %]</b>[% @layer_name %]",
+            "Invalid [% \"name\" || %], eval error [% to_int('a') / 0 %].",
+            '[% "name" ',
+        )
+        for text in texts:
+            template = ExpressionTemplate(text)
+            for name, value in (("first", 1.0), ("second", 2.5)):
+                feature = QgsFeature(layer.fields())
+                feature.setAttributes([name, value, None])
+                feature.setGeometry(QgsGeometry.fromWkt("POLYGON((0 0,0 10,10 10,10 0,0 0))"))
+                context.setFeature(feature)
+                context.setFields(feature.fields())
+                if name == "first":
+                    template.prepare(context, distance_area)
+
+                expected = QgsExpression.replaceExpressionText(text, context, distance_area)
+                self.assertEqual(expected, template.render(context), text)
+
+    def test_expression_template_cache(self):
+        """Test the template is parsed once."""
+        template = expression_template("[% 1 + 1 %]")
+        self.assertIs(template, expression_template("[% 1 + 1 %]"))
+        self.assertEqual(1, len(template.expressions()))
+        template.prepare(QgsExpressionContext())
+        self.assertEqual("2", template.render(QgsExpressionContext()))
+
+    def test_render_with_project_units(self):
+        """Test the template ignores the project units, as QgsExpression.replaceExpressionText."""
+        project = QgsProject.instance()
+        distance_units = project.distanceUnits()
+        area_units = project.areaUnits()
+        project.setDistanceUnits(Qgis.DistanceUnit.Feet)
+        project.setAreaUnits(Qgis.AreaUnit.SquareFeet)
+        try:
+            layer = QgsVectorLayer("Polygon?crs=epsg:2154", "polygons", "memory")
+            context = QgsExpressionContext()
+            context.appendScope(QgsExpressionContextUtils.projectScope(project))
+            context.appendScope(QgsExpressionContextUtils.layerScope(layer))
+
+            distance_area = QgsDistanceArea()
+            distance_area.setSourceCrs(layer.crs(), project.transformContext())
+
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry(QgsGeometry.fromWkt("POLYGON((0 0,0 10,10 10,10 0,0 0))"))
+            context.setFeature(feature)
+
+            text = "[% $area %] [% $perimeter %]"
+            template = ExpressionTemplate(text)
+            template.prepare(context, distance_area)
+            self.assertEqual(
+                QgsExpression.replaceExpressionText(text, context, distance_area),
+                template.render(context),
+            )
+        finally:
+            project.setDistanceUnits(distance_units)
+            project.setAreaUnits(area_units)
+
+    def test_parser_error_not_cached(self):
+        """Test a template with a parser error is not cached and rendered by QGIS."""
+        _template_cache.clear()
+        text = 'Invalid [% "name" || %], valid [% 1 + 1 %]'
+        template = expression_template(text)
+        self.assertTrue(template.has_parser_error)
+        self.assertEqual(0, len(_template_cache))
+
+        context = QgsExpressionContext()
+        template.prepare(context)
+        self.assertEqual(QgsExpression.replaceExpressionText(text, context), template.render(context))
+
+        self.assertFalse(expression_template("[% 1 + 1 %]").has_parser_error)
+        self.assertEqual(1, len(_template_cache))
+        _template_cache.clear()
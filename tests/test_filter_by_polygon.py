@@ -1,18 +1,38 @@
 """Test filter by polygon."""
 
+import os
 import unittest
 
+from unittest import mock
+
 from qgis.core import (
     QgsCoordinateReferenceSystem,
+    QgsCoordinateTransform,
     QgsDataSourceUri,
     QgsFeature,
     QgsGeometry,
     QgsProject,
+    QgsRectangle,
     QgsVectorLayer,
     edit,
 )
 
-from lizmap_server.filter_by_polygon import FilterByPolygon
+from lizmap_server.filter_by_polygon import (
+    CachedPolygon,
+    FilterByPolygon,
+    FilterType,
+    MaterializedSubset,
+    MaterializedSubsets,
+    PreparedPolygon,
+    MATERIALIZE_INTERVAL_KEY,
+    SUBSET_MAX_SIZE_KEY,
+    _index_cache,
+    _polygon_cache,
+    clear_polygon_cache,
+    quote_identifier,
+    quote_literal,
+    sql_compose,
+)
 
 
 class TestFilterByPolygon(unittest.TestCase):
@@ -173,6 +193,22 @@ class TestFilterByPolygon(unittest.TestCase):
         )
         # self.assertEqual('"id" IN (1, 3)', config.subset_sql(groups))
         # self.assertEqual('', config.subset_sql(groups))
+
+        # The polygons are cached for the polygon layer and the groups, whatever the order
+        key = (polygon.id(), polygon.source(), "groups", frozenset(groups), 0)
+        self.assertIsNotNone(_polygon_cache.get(key))
+        # With the serialized polygon
+        self.assertEqual(
+            "MultiPolygon (((0 0, 0 5, 5 5, 5 0, 0 0)),((0 0, 0 -5, -5 -5, -5 0, 0 0)))",
+            _polygon_cache.get(key).wkt(0),
+        )
+        size = len(_polygon_cache)
+        cached = config._cached_polygon(("admins", "east"))
+        self.assertEqual(size + 1, len(_polygon_cache))
+        self.assertIs(cached, config._cached_polygon(("east", "admins")))
+        self.assertEqual(size + 1, len(_polygon_cache))
+        clear_polygon_cache(polygon.id())
+        self.assertIsNone(_polygon_cache.get(key))
         project.clear()
 
     def test_format_sql_in(self):
@@ -192,6 +228,25 @@ class TestFilterByPolygon(unittest.TestCase):
         expected = "\"code\" IN ( 'a' , 'b' , 'c' )"
         self.assertEqual(expected, sql)
 
+        # String with a quote
+        sql = FilterByPolygon._format_sql_in("code", ("a'b",))
+        expected = "\"code\" IN ( 'a''b' )"
+        self.assertEqual(expected, sql)
+
+        # String with a backslash
+        sql = FilterByPolygon._format_sql_in("code", ("a\\'b",))
+        expected = "\"code\" IN ( E'a\\\\''b' )"
+        self.assertEqual(expected, sql)
+
+        # Consecutive integers as ranges
+        sql = FilterByPolygon._format_sql_in("code", (12, 1, 2, 3, 4, 5, 10, 3, 20, 21, 22, 23))
+        expected = '( "code" BETWEEN 1 AND 5 OR "code" BETWEEN 20 AND 23 OR "code" IN ( 10 , 12 ) )'
+        self.assertEqual(expected, sql)
+
+        sql = FilterByPolygon._format_sql_in("code", list(range(1, 10001)))
+        expected = '"code" BETWEEN 1 AND 10000'
+        self.assertEqual(expected, sql)
+
     def test_format_qgis_expression(self):
         """Test building a QGIS expression."""
         sql = FilterByPolygon._format_qgis_expression_relationship(
@@ -289,3 +344,262 @@ ST_Contains(
         )
 
         self.assertEqual('(SELECT * FROM "public"."roads")', FilterByPolygon._format_table_name(uri))
+
+    def test_quote_sql(self):
+        """Test quoting identifiers and literals without a connection."""
+        self.assertEqual('"groups"', quote_identifier("groups"))
+        self.assertEqual('"my ""group"""', quote_identifier('my "group"'))
+        self.assertEqual("'admins,east'", quote_literal("admins,east"))
+        self.assertEqual("'it''s'", quote_literal("it's"))
+        self.assertEqual("E'a\\\\b'''", quote_literal("a\\b'"))
+
+        # Only quoted fragments are composed
+        self.assertEqual(
+            """SELECT "id" FROM "t" WHERE "name" = 'it''s'""",
+            sql_compose(
+                "SELECT {pk} FROM {table} WHERE {field} = {value}",
+                pk=quote_identifier("id"),
+                table=quote_identifier("t"),
+                field=quote_identifier("name"),
+                value=quote_literal("it's"),
+            ),
+        )
+        with self.assertRaises(TypeError):
+            sql_compose("SELECT {pk} FROM t", pk="id; DROP TABLE t")
+
+    def test_spatial_index_cache(self):
+        """Test the spatial index is kept for a file based layer."""
+        data_path = os.path.join(os.path.dirname(__file__), "data", "france_parts")
+        layer = QgsVectorLayer(os.path.join(data_path, "france_parts.shp"), "france_parts", "ogr")
+        self.assertTrue(layer.isValid())
+        polygon = QgsVectorLayer(
+            "Polygon?crs=epsg:4326&field=id:integer&field=groups:string", "polygon", "memory"
+        )
+        project = QgsProject.instance()
+        project.addMapLayers([layer, polygon])
+
+        json = {
+            "config": {
+                "polygon_layer_id": polygon.id(),
+                "group_field": "groups",
+            },
+            "layers": [
+                {
+                    "layer": layer.id(),
+                    "primary_key": "OBJECTID",
+                    "spatial_relationship": "intersects",
+                    "filter_mode": "display_and_editing",
+                },
+            ],
+        }
+        config = FilterByPolygon(json, layer)
+        self.assertIsNotNone(config._layer_last_modified())
+
+        _index_cache.clear()
+        index = config._spatial_index()
+        self.assertEqual(1, len(_index_cache))
+        self.assertIs(index, FilterByPolygon(json, layer)._spatial_index())
+        self.assertEqual(1, len(_index_cache))
+        _index_cache.clear()
+        project.clear()
+
+    def test_prepared_polygon(self):
+        """Test spatial relationships with a prepared polygon."""
+        prepared = PreparedPolygon(QgsGeometry.fromWkt("POLYGON((0 0,0 16,16 16,16 0,0 0))"))
+        self.assertTrue(prepared.is_interior(QgsRectangle(1.5, 1.5, 1.8, 1.8)))
+        # On a cell border or on the polygon boundary, an exact test is needed
+        self.assertFalse(prepared.is_interior(QgsRectangle(0.5, 0.5, 1.5, 1.5)))
+        self.assertFalse(prepared.is_interior(QgsRectangle(0, 0.5, 0.5, 0.8)))
+
+        inside = QgsGeometry.fromWkt("POINT(1.5 1.5)")
+        boundary = QgsGeometry.fromWkt("LINESTRING(-1 8, 8 8)")
+        border = QgsGeometry.fromWkt("POINT(0 8)")
+        outside = QgsGeometry.fromWkt("POINT(20 20)")
+        self.assertTrue(prepared.contains(inside))
+        self.assertTrue(prepared.intersects(inside))
+        self.assertFalse(prepared.contains(boundary))
+        self.assertTrue(prepared.intersects(boundary))
+        self.assertFalse(prepared.contains(border))
+        self.assertTrue(prepared.intersects(border))
+        self.assertFalse(prepared.contains(outside))
+        self.assertFalse(prepared.intersects(outside))
+        self.assertFalse(prepared.intersects(QgsGeometry()))
+
+    def test_cached_prepared_polygon(self):
+        """Test the prepared polygon is kept by CRS."""
+        cached = CachedPolygon(QgsGeometry.fromWkt("POLYGON((0 0,0 16,16 16,16 0,0 0))"))
+        project = QgsProject.instance()
+        crs_2154 = QgsCoordinateReferenceSystem("EPSG:2154")
+        crs_4326 = QgsCoordinateReferenceSystem("EPSG:4326")
+        same = QgsCoordinateTransform(crs_2154, crs_2154, project)
+        other = QgsCoordinateTransform(crs_2154, crs_4326, project)
+
+        prepared = cached.prepared(same)
+        self.assertIs(prepared, cached.prepared(QgsCoordinateTransform(crs_2154, crs_2154, project)))
+        self.assertTrue(prepared.contains(QgsGeometry.fromWkt("POINT(1.5 1.5)")))
+        self.assertIsNot(prepared, cached.prepared(other))
+
+        # Custom CRS without authid
+        custom_a = QgsCoordinateReferenceSystem.fromProj(
+            "+proj=tmerc +lat_0=0 +lon_0=3.123 +k=1 +x_0=0 +y_0=0 +ellps=GRS80 +units=m +no_defs"
+        )
+        custom_b = QgsCoordinateReferenceSystem.fromProj(
+            "+proj=tmerc +lat_0=0 +lon_0=4.456 +k=1 +x_0=0 +y_0=0 +ellps=GRS80 +units=m +no_defs"
+        )
+        prepared_a = cached.prepared(QgsCoordinateTransform(crs_2154, custom_a, project))
+        prepared_b = cached.prepared(QgsCoordinateTransform(crs_2154, custom_b, project))
+        self.assertIsNot(prepared_a, prepared_b)
+        self.assertFalse(prepared_a.polygon.equals(prepared_b.polygon))
+        # The cached polygon is not transformed
+        self.assertEqual(16, cached.geometry.boundingBox().xMaximum())
+
+    def test_polygon_tolerance(self):
+        """Test snapping the polygon before serializing it."""
+        polygon = QgsVectorLayer(
+            "Polygon?crs=epsg:2154&field=id:integer&field=groups:string", "polygon", "memory"
+        )
+        with edit(polygon):
+            feature = QgsFeature(polygon.fields())
+            feature.setGeometry(QgsGeometry.fromWkt("POLYGON((0.1 0,0 5.2,5 5,5 0.2,4.9 0.1,0.1 0))"))
+            feature.setAttributes([1, "east"])
+            self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer("Point?crs=epsg:2154&field=id:integer", "points", "memory")
+        project = QgsProject.instance()
+        project.addMapLayers([points, polygon])
+
+        json = {
+            "config": {
+                "polygon_layer_id": polygon.id(),
+                "group_field": "groups",
+            },
+            "layers": [
+                {
+                    "layer": points.id(),
+                    "primary_key": "id",
+                    "spatial_relationship": "intersects",
+                    "filter_mode": "display_and_editing",
+                },
+            ],
+        }
+        config = FilterByPolygon(json, points, filter_type=FilterType.QgisExpression)
+        with mock.patch.dict(os.environ, {"QGIS_SERVER_LIZMAP_FILTER_BY_POLYGON_TOLERANCE": "1"}):
+            _, ewkt = config.subset_sql(("east",))
+            self.assertEqual("SRID=2154;MultiPolygon (((0 0, 0 5, 5 5, 5 0, 0 0)))", ewkt)
+
+        _, ewkt = config.subset_sql(("east",))
+        self.assertEqual("SRID=2154;MultiPolygon (((0.1 0, 0 5.2, 5 5, 5 0.2, 4.9 0.1, 0.1 0)))", ewkt)
+        clear_polygon_cache()
+        project.clear()
+
+    def test_materialize_polygon_not_postgres(self):
+        """Test the subset string is not materialized when the polygon layer is not in PostgreSQL."""
+        polygon = QgsVectorLayer(
+            "Polygon?crs=epsg:2154&field=id:integer&field=groups:string", "polygon", "memory"
+        )
+        with edit(polygon):
+            feature = QgsFeature(polygon.fields())
+            feature.setGeometry(QgsGeometry.fromWkt("POLYGON((0 0,0 5,5 5,5 0,0 0))"))
+            feature.setAttributes([1, "east"])
+            self.assertTrue(polygon.addFeature(feature))
+
+        points = QgsVectorLayer("Point?crs=epsg:2154&field=id:integer", "points", "memory")
+        project = QgsProject.instance()
+        project.addMapLayers([points, polygon])
+
+        json = {
+            "config": {
+                "polygon_layer_id": polygon.id(),
+                "group_field": "groups",
+            },
+            "layers": [
+                {
+                    "layer": points.id(),
+                    "primary_key": "id",
+                    "spatial_relationship": "intersects",
+                    "filter_mode": "display_and_editing",
+                },
+            ],
+        }
+        config = FilterByPolygon(json, points)
+        # The filtered layer is in PostgreSQL, not the polygon layer
+        config.layer = mock.Mock(wraps=points)
+        config.layer.providerType.return_value = "postgres"
+        patch_env = mock.patch.dict(os.environ, {MATERIALIZE_INTERVAL_KEY: "60"})
+        patch_probe = mock.patch.object(MaterializedSubsets, "probe")
+        patch_subset = mock.patch.object(
+            FilterByPolygon, "_features_ids_subset", return_value='"id" IN ( 1 )'
+        )
+        with patch_env, patch_probe as probe, patch_subset:
+            subset, _ = config.subset_sql(("east",))
+        self.assertEqual('"id" IN ( 1 )', subset)
+        self.assertEqual(0, probe.call_count)
+        clear_polygon_cache()
+        project.clear()
+
+    def test_materialized_subsets(self):
+        """Test refreshing the materialized subset strings."""
+        materialized = MaterializedSubsets(max_size=10)
+        entry = MaterializedSubset(
+            subset='"id" IN ( 1 )',
+            layer_uri='dbname=\'lizmap\' table="public"."points"',
+            query='SELECT "id" FROM "public"."points" WHERE ST_Intersects(...)',
+            primary_key="id",
+            layer_probe='SELECT count(*) FROM "public"."points" AS t',
+            layer_state="[[1]]",
+            polygon_uri='dbname=\'lizmap\' table="public"."polygons"',
+            polygon_probe='SELECT count(*) FROM "public"."polygons" AS t',
+            polygon_state="[[2]]",
+        )
+        key = ("points_id", "points_source", "polygons_id", "polygons_source", frozenset(("east",)))
+        with mock.patch.object(MaterializedSubsets, "start"):
+            materialized.set(key, entry, 60)
+        self.assertEqual('"id" IN ( 1 )', materialized.get(key))
+
+        states = {entry.layer_probe: "[[1]]", entry.polygon_probe: "[[2]]"}
+        patch_probe = mock.patch.object(
+            MaterializedSubsets, "probe", side_effect=lambda _, probe: states[probe]
+        )
+        patch_subset = mock.patch.object(
+            FilterByPolygon, "_features_ids_subset", return_value='"id" IN ( 1 , 2 )'
+        )
+        with patch_probe, patch_subset as features_ids_subset:
+            # Nothing has changed
+            materialized.refresh()
+            self.assertEqual(0, features_ids_subset.call_count)
+            self.assertEqual('"id" IN ( 1 )', materialized.get(key))
+
+            # The filtered table has changed
+            states[entry.layer_probe] = "[[2]]"
+            materialized.refresh()
+            self.assertEqual(1, features_ids_subset.call_count)
+            self.assertEqual('"id" IN ( 1 , 2 )', materialized.get(key))
+            materialized.refresh()
+            self.assertEqual(1, features_ids_subset.call_count)
+
+            # The polygon table has changed
+            states[entry.polygon_probe] = "[[3]]"
+            materialized.refresh()
+            self.assertIsNone(materialized.get(key))
+
+        # Too old, computed again even if the probes have not changed
+        entry = entry._replace(polygon_state="[[3]]")
+        with mock.patch.object(MaterializedSubsets, "start"):
+            materialized.set(key, entry, 60)
+        with patch_probe, patch_subset as features_ids_subset:
+            with mock.patch("lizmap_server.filter_by_polygon.time.monotonic", return_value=1e9):
+                materialized.refresh()
+            self.assertEqual(1, features_ids_subset.call_count)
+            self.assertEqual('"id" IN ( 1 , 2 )', materialized.get(key))
+
+        # Too old, not returned
+        with mock.patch("lizmap_server.filter_by_polygon.time.monotonic", return_value=2e9):
+            self.assertIsNone(materialized.get(key))
+
+        # Too long when refreshed, removed
+        with mock.patch.object(MaterializedSubsets, "start"):
+            materialized.set(key, entry, 60)
+        states[entry.layer_probe] = "[[4]]"
+        with patch_probe, patch_subset, mock.patch.dict(os.environ, {SUBSET_MAX_SIZE_KEY: "10"}):
+            materialized.refresh()
+        self.assertIsNone(materialized.get(key))
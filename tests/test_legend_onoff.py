@@ -3,6 +3,7 @@ import logging
 
 from qgis.core import Qgis
 
+from lizmap_server.legend_onoff_filter import parse_legend_parameter
 from tests.utils import _build_query_string
 
 from PIL import Image
@@ -27,6 +28,14 @@ BASE_QUERY = {
 }
 
 
+def test_parse_legend_parameter():
+    """Test LEGEND_ON and LEGEND_OFF are parsed into rule keys by layer."""
+    assert parse_legend_parameter("") == {}
+    assert parse_legend_parameter("categorized:0,1;rule_based:;:2;categorized:3") == {
+        "categorized": {"0", "1", "3"},
+    }
+
+
 def test_unique_symbol(client):
     """Test unique symbol for layer."""
     project = client.get_project(PROJECT)
@@ -1,13 +1,18 @@
+import json
 import unittest
 
+from unittest import mock
+
 from qgis.core import (
+    QgsCategorizedSymbolRenderer,
+    QgsRendererCategory,
     QgsRuleBasedRenderer,
     QgsSymbol,
     QgsVectorLayer,
     QgsWkbTypes,
 )
 
-from lizmap_server.get_legend_graphic import GetLegendGraphicFilter
+from lizmap_server.get_legend_graphic import GetLegendGraphicFilter, _feature_count_cache, _legend_cache
 
 
 class TestLegend(unittest.TestCase):
@@ -70,3 +75,97 @@ class TestLegend(unittest.TestCase):
             self.assertEqual(0, symbol.scaleMinDenom)
             self.assertEqual("TRUE", symbol.expression)
             self.assertIn(symbol.title, ("rule-1", "same-label", "rule-2"))
+
+    def test_legend_categories_cache(self):
+        """Test the categories of the legend are computed once, not the check state."""
+        layer = QgsVectorLayer("Point?field=fldtxt:string", "layer1", "memory")
+        renderer = QgsCategorizedSymbolRenderer(
+            "fldtxt",
+            [
+                QgsRendererCategory(
+                    value, QgsSymbol.defaultSymbol(QgsWkbTypes.GeometryType.PointGeometry), value.upper()
+                )
+                for value in ("a", "b")
+            ],
+        )
+        layer.setRenderer(renderer)
+
+        _legend_cache.clear()
+        categories = GetLegendGraphicFilter._legend_categories(layer)
+        self.assertIs(categories, GetLegendGraphicFilter._legend_categories(layer))
+        self.assertEqual(1, len(_legend_cache))
+        self.assertEqual("\"fldtxt\" = 'a'", categories[0].expression)
+
+        layer.renderer().checkLegendSymbolItem(categories[1].ruleKey, False)
+        result = GetLegendGraphicFilter._extract_categories(layer)
+        self.assertListEqual(["A", "B"], list(result.keys()))
+        self.assertTrue(result["A"].checked)
+        self.assertFalse(result["B"].checked)
+        self.assertEqual(1, len(_legend_cache))
+
+        # Feature counts, kept during the request by default
+        _feature_count_cache.clear()
+        counts = GetLegendGraphicFilter._feature_counts(layer)
+        self.assertListEqual([category.ruleKey for category in categories], list(counts.keys()))
+        self.assertIs(counts, GetLegendGraphicFilter._feature_counts(layer))
+        _feature_count_cache.new_request()
+        self.assertEqual(0, len(_feature_count_cache))
+
+        # Kept between requests by subset string with a TTL
+        with mock.patch.object(_feature_count_cache, "ttl", 60):
+            counts = GetLegendGraphicFilter._feature_counts(layer)
+            _feature_count_cache.new_request()
+            self.assertIs(counts, GetLegendGraphicFilter._feature_counts(layer))
+            layer.setSubsetString("\"fldtxt\" = 'a'")
+            self.assertIsNot(counts, GetLegendGraphicFilter._feature_counts(layer))
+            self.assertEqual(2, len(_feature_count_cache))
+        _feature_count_cache.clear()
+
+        _legend_cache.clear()
+
+    def test_invalid_layer_legend(self):
+        """Test the legend of an invalid layer is built once."""
+        icon = GetLegendGraphicFilter.warning_icon()
+        self.assertIs(icon, GetLegendGraphicFilter.warning_icon())
+
+        body = GetLegendGraphicFilter.invalid_layer_legend("invalid")
+        self.assertIs(body, GetLegendGraphicFilter.invalid_layer_legend("invalid"))
+        self.assertDictEqual(
+            {
+                "title": "",
+                "nodes": [{"type": "layer", "title": "invalid", "icon": icon, "valid": False}],
+            },
+            json.loads(body),
+        )
+
+    def test_style_renderer(self):
+        """Test the renderer of another style, without changing the current style."""
+        layer = QgsVectorLayer("Point?field=fldtxt:string", "layer1", "memory")
+        style_manager = layer.styleManager()
+        current_style = style_manager.currentStyle()
+        style_manager.addStyleFromLayer("categorized")
+        style_manager.setCurrentStyle("categorized")
+        layer.setRenderer(
+            QgsCategorizedSymbolRenderer(
+                "fldtxt",
+                [
+                    QgsRendererCategory(
+                        value, QgsSymbol.defaultSymbol(QgsWkbTypes.GeometryType.PointGeometry), value.upper()
+                    )
+                    for value in ("a", "b")
+                ],
+            )
+        )
+        style_manager.setCurrentStyle(current_style)
+        self.assertEqual("singleSymbol", layer.renderer().type())
+
+        self.assertIs(layer.renderer(), GetLegendGraphicFilter._style_renderer(layer))
+        renderer = GetLegendGraphicFilter._style_renderer(layer, "categorized")
+        self.assertEqual("categorizedSymbol", renderer.type())
+        self.assertIs(renderer, GetLegendGraphicFilter._style_renderer(layer, "categorized"))
+        self.assertIsNone(GetLegendGraphicFilter._style_renderer(layer, "unknown"))
+
+        result = GetLegendGraphicFilter._extract_categories(layer, style="categorized")
+        self.assertListEqual(["A", "B"], list(result.keys()))
+        self.assertEqual(current_style, style_manager.currentStyle())
+        self.assertEqual("singleSymbol", layer.renderer().type())
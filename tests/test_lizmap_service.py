@@ -106,3 +106,50 @@ def test_lizmap_service_filter_polygon_without_user(client):
     b = json.loads(rv.content.decode("utf-8"))
 
     assert b == {"filter": "1 = 0", "polygons": "", "status": "success"}
+
+
+def test_lizmap_service_filter_polygon_many_layers(client):
+    """Test get polygon filters of many layers at once with the Lizmap service."""
+    project_file = "test_filter_layer_data_by_polygon_for_groups.qgs"
+
+    qs = (
+        "?SERVICE=LIZMAP&REQUEST=GETSUBSETSTRING&MAP=france_parts.qgs&"
+        "LAYERS=shop_bakery,townhalls_EPSG2154,polygons&"
+        "LIZMAP_USER_GROUPS=montferrier-sur-lez&"
+    )
+    rv = client.get(qs, project_file)
+    assert rv.status_code == 200
+
+    assert rv.headers.get("Content-Type", "").find("application/json") == 0
+
+    b = json.loads(rv.content.decode("utf-8"))
+
+    assert b["status"] == "success"
+    assert list(b["layers"].keys()) == ["shop_bakery", "townhalls_EPSG2154", "polygons"]
+    assert b["layers"]["shop_bakery"]["filter"] == '"id" IN ( 68 )'
+    assert b["layers"]["shop_bakery"]["polygons"].startswith("SRID=3857;MultiPolygon")
+    # Editing only
+    assert b["layers"]["townhalls_EPSG2154"] == {"filter": "", "polygons": ""}
+    # Not filtered
+    assert b["layers"]["polygons"] == {"filter": "", "polygons": ""}
+
+    # Spaces around the layer names
+    qs = (
+        "?SERVICE=LIZMAP&REQUEST=GETSUBSETSTRING&MAP=france_parts.qgs&"
+        "LAYERS=shop_bakery, polygons&"
+        "LIZMAP_USER_GROUPS=montferrier-sur-lez&"
+    )
+    rv = client.get(qs, project_file)
+    assert rv.status_code == 200
+    b = json.loads(rv.content.decode("utf-8"))
+    assert list(b["layers"].keys()) == ["shop_bakery", "polygons"]
+
+    # Unknown layer
+    qs = "?SERVICE=LIZMAP&REQUEST=GETSUBSETSTRING&MAP=france_parts.qgs&LAYERS=shop_bakery,foo&"
+    rv = client.get(qs, project_file)
+    assert rv.status_code == 400
+
+    # Unknown layer, same error with a single layer
+    qs = "?SERVICE=LIZMAP&REQUEST=GETSUBSETSTRING&MAP=france_parts.qgs&LAYER=foo&"
+    rv = client.get(qs, project_file)
+    assert rv.status_code == 400
@@ -4,13 +4,37 @@ import os
 import unittest
 import xml.etree.ElementTree as ET
 
+from unittest import mock
+
+from qgis.core import (
+    Qgis,
+    QgsEditorWidgetSetup,
+    QgsExpression,
+    QgsExpressionContext,
+    QgsExpressionContextUtils,
+    QgsFeature,
+    QgsProject,
+    QgsVectorLayer,
+)
+
 from lizmap_server.core import (
+    LizmapConfigCache,
+    LizmapConfigView,
+    find_layer,
     get_lizmap_config,
     get_lizmap_layer_login_filter,
     get_lizmap_layers_config,
 )
-from lizmap_server.get_feature_info import GetFeatureInfoFilter
+from lizmap_server.expression_template import expression_template
+from lizmap_server.get_feature_info import (
+    REPRESENT_VALUE_CONTEXT_KEY,
+    GetFeatureInfoFilter,
+    Result,
+    _popup_cache,
+    _represent_value_cache,
+)
 from lizmap_server.tools import to_bool
+from lizmap_server.tooltip import Tooltip
 
 
 class TestServerCore(unittest.TestCase):
@@ -34,6 +58,141 @@ class TestServerCore(unittest.TestCase):
         qgis_project_path = os.path.join(data_path, "france_parts_liz.qgs")
         self.assertIsNotNone(get_lizmap_config(qgis_project_path))
 
+    def test_lizmap_config_cache(self):
+        """Test the Lizmap config is checked once per request"""
+        data_path = os.path.join(os.path.dirname(__file__), "data")
+        qgis_project_path = os.path.join(data_path, "france_parts_liz_grp_v.qgs")
+
+        cache = LizmapConfigCache(ttl=0)
+        self.assertIsNone(cache.get(os.path.join(data_path, "foobar.qgs")))
+
+        config = cache.get(qgis_project_path)
+        self.assertIsNotNone(config)
+        # Same request, same object
+        self.assertIs(config, cache.get(qgis_project_path))
+
+        # New request, the file has not been modified
+        cache.new_request()
+        self.assertIs(config, cache.get(qgis_project_path))
+
+        # Bounded size
+        cache = LizmapConfigCache(max_size=1, ttl=0)
+        cache.get(qgis_project_path)
+        cache.get(os.path.join(data_path, "france_parts_liz.qgs"))
+        self.assertEqual(1, len(cache._entries))
+
+    def test_lizmap_config_view(self):
+        """Test the indexed Lizmap config"""
+        config = LizmapConfigView(
+            {
+                "options": {"acl": ["admins"]},
+                "layers": {
+                    "lines": {"id": "lines_id", "group_visibility": [" admins", "test "]},
+                    "points": {"id": "points_id", "group_visibility": []},
+                },
+                "editionLayers": {"lines_id": {"acl": "admins"}},
+                "loginFilteredLayers": {
+                    "lines": {
+                        "layerId": "lines_id",
+                        "filterAttribute": "name",
+                        "filterPrivate": "False",
+                    },
+                    "points": {"layerId": "points_id"},
+                },
+            },
+            0.0,
+        )
+        self.assertDictEqual({"acl": ["admins"]}, config.options)
+        self.assertListEqual(["lines", "points"], list(config.layers.keys()))
+        self.assertIs(config.layers["lines"], config.layers_by_id["lines_id"])
+        self.assertIn("lines_id", config.edition_layers)
+        self.assertIsNotNone(config.login_filter("lines"))
+        self.assertIsNone(config.login_filter("points"))
+        self.assertDictEqual({"lines": frozenset(("admins", "test"))}, config.group_visibility)
+        self.assertEqual(2, config.max_group_visibility_size)
+        self.assertDictEqual({"lines_id": frozenset(("admins",))}, config.edition_acl)
+        self.assertDictEqual(
+            {"admins": frozenset(("lines",)), "test": frozenset(("lines",))},
+            config.visible_layers_by_group,
+        )
+        self.assertEqual(frozenset(("lines",)), config.visible_layers(("test", "other")))
+        self.assertEqual(frozenset(), config.visible_layers(("other",)))
+        self.assertEqual(frozenset(), config.visible_layers(()))
+
+        self.assertEqual(frozenset(), config.form_popup_layers)
+
+        config = LizmapConfigView({"layers": "bar"}, 0.0)
+        self.assertDictEqual({}, config.layers)
+        self.assertDictEqual({}, config.edition_layers)
+        self.assertDictEqual({}, config.login_filters)
+        self.assertEqual(0, config.max_group_visibility_size)
+
+        # Malformed values match no group, the other layers are indexed
+        config = LizmapConfigView(
+            {
+                "layers": {
+                    "lines": {"id": ["lines_id"], "group_visibility": ["admins", 1]},
+                    "points": {"id": "points_id", "group_visibility": 1},
+                    "polygons": {"id": "polygons_id", "group_visibility": ["test"]},
+                },
+                "editionLayers": {
+                    "lines_id": {"acl": ["admins", " test"]},
+                    "points_id": {"acl": 1},
+                    "polygons_id": {"acl": "admins, test"},
+                },
+            },
+            0.0,
+        )
+        self.assertListEqual(["points_id", "polygons_id"], list(config.layers_by_id.keys()))
+        self.assertDictEqual(
+            {
+                "lines": frozenset(("admins",)),
+                "points": frozenset(),
+                "polygons": frozenset(("test",)),
+            },
+            config.group_visibility,
+        )
+        self.assertDictEqual(
+            {
+                "lines_id": frozenset(("admins", "test")),
+                "points_id": frozenset(),
+                "polygons_id": frozenset(("admins", "test")),
+            },
+            config.edition_acl,
+        )
+
+    def test_find_layer(self):
+        """Test find layer with name, short name or layer ID"""
+        project = QgsProject()
+        points = QgsVectorLayer("Point?field=id:integer", "points", "memory")
+        if Qgis.versionInt() < 33800:
+            points.setShortName("short-points")
+        else:
+            points.serverProperties().setShortName("short-points")
+        project.addMapLayer(points)
+
+        self.assertEqual(points.id(), find_layer("points", project).id())
+        self.assertEqual(points.id(), find_layer("short-points", project).id())
+        self.assertEqual(points.id(), find_layer(points.id(), project).id())
+        self.assertIsNone(find_layer("lines", project))
+
+        # Layer added
+        lines = QgsVectorLayer("LineString?field=id:integer", "lines", "memory")
+        project.addMapLayer(lines)
+        self.assertEqual(lines.id(), find_layer("lines", project).id())
+
+        # Layer renamed
+        lines.setName("renamed-lines")
+        self.assertIsNone(find_layer("lines", project))
+        self.assertEqual(lines.id(), find_layer("renamed-lines", project).id())
+
+        # Layer removed
+        lines_id = lines.id()
+        project.removeMapLayer(lines_id)
+        self.assertIsNone(find_layer("renamed-lines", project))
+        self.assertIsNone(find_layer(lines_id, project))
+        self.assertEqual(points.id(), find_layer("points", project).id())
+
     def test_get_lizmap_layers_config(self):
         """Test get layers Lizmap config"""
 
@@ -236,7 +395,6 @@ class TestServerCore(unittest.TestCase):
             self.assertIn(name, expected_unchanged_attributes)
             self.assertEqual(attr.attrib.get("value"), expected_unchanged_attributes.get(name))
 
-
     def test_edit_xml_get_feature_info_with_maptip(self):
         """Test to edit a GetFeatureInfo xml with maptip."""
         string = """<GetFeatureInfoResponse>
@@ -299,3 +457,168 @@ class TestServerCore(unittest.TestCase):
                 continue
             self.assertIn(name, expected_unchanged_attributes)
             self.assertEqual(attr.attrib.get("value"), expected_unchanged_attributes.get(name))
+
+    def test_set_maptips_get_feature_info(self):
+        """Test to edit many maptips of a GetFeatureInfo xml at once."""
+        string = """<GetFeatureInfoResponse>
+         <Layer name="layer_a">
+          <Feature id="1">
+           <Attribute name="name" value="one"/>
+          </Feature>
+          <Feature id="2">
+           <Attribute name="name" value="two"/>
+           <Attribute name="maptip" value="Hello"/>
+          </Feature>
+         </Layer>
+         <Layer name="layer_b">
+          <Feature id="1">
+           <Attribute name="name" value="three"/>
+          </Feature>
+         </Layer>
+        </GetFeatureInfoResponse>
+        """
+        dom_doc = GetFeatureInfoFilter.parse_document(string)
+        self.assertListEqual(
+            [("layer_a", "1"), ("layer_a", "2"), ("layer_b", "1")],
+            list(GetFeatureInfoFilter.parse_xml(dom_doc)),
+        )
+
+        GetFeatureInfoFilter.set_maptips(
+            dom_doc,
+            {
+                ("layer_a", "2"): "<b>two</b>",
+                ("layer_b", "1"): "<b>three</b>",
+            },
+        )
+        gfi = ET.fromstring(dom_doc.toString())
+        maptips = [
+            (layer.attrib.get("name"), feature.attrib.get("id"), maptip.attrib.get("value"))
+            for layer in gfi
+            for feature in layer
+            for maptip in feature.findall("Attribute[@name='maptip']")
+        ]
+        self.assertListEqual([("layer_a", "2", "<b>two</b>"), ("layer_b", "1", "<b>three</b>")], maptips)
+
+    def test_form_popup_cache(self):
+        """Test the popup template from a form is generated once by layer and CSS framework."""
+        project = QgsProject()
+        layer = QgsVectorLayer("Point?field=name:string", "points", "memory")
+        project.addMapLayer(layer)
+        config = layer.editFormConfig()
+
+        _popup_cache.clear()
+        with mock.patch.object(
+            Tooltip, "create_popup_node_item_from_form", return_value="[% name %]"
+        ) as create:
+            popup = GetFeatureInfoFilter.form_popup(
+                layer, config, project, project.relationManager(), "BOOTSTRAP5"
+            )
+            self.assertIn("[% name %]", popup)
+            self.assertEqual(
+                popup,
+                GetFeatureInfoFilter.form_popup(
+                    layer, config, project, project.relationManager(), "BOOTSTRAP5"
+                ),
+            )
+            self.assertEqual(1, create.call_count)
+
+            # Another CSS framework
+            popup = GetFeatureInfoFilter.form_popup(layer, config, project, project.relationManager(), "")
+            self.assertTrue(popup.endswith(Tooltip.css))
+            self.assertEqual(2, create.call_count)
+        _popup_cache.clear()
+
+    def test_query_form_popup_get_feature_info(self):
+        """Test if the GetFeatureInfo queries a layer having a popup from the form."""
+        project = QgsProject()
+        points = QgsVectorLayer("Point?field=name:string", "points", "memory")
+        lines = QgsVectorLayer("LineString?field=name:string", "lines", "memory")
+        project.addMapLayers([points, lines])
+
+        config = LizmapConfigView(
+            {
+                "layers": {
+                    "points": {"id": points.id(), "popup": "True", "popupSource": "form"},
+                    "lines": {"id": lines.id(), "popup": "True", "popupSource": "lizmap"},
+                },
+            },
+            0.0,
+        )
+        self.assertEqual(frozenset(("points",)), config.form_popup_layers)
+
+        self.assertTrue(GetFeatureInfoFilter.query_form_popup(config, project, "points"))
+        self.assertTrue(GetFeatureInfoFilter.query_form_popup(config, project, f"lines,{points.id()}"))
+        self.assertFalse(GetFeatureInfoFilter.query_form_popup(config, project, "lines"))
+        # Not a layer, a group for instance
+        self.assertTrue(GetFeatureInfoFilter.query_form_popup(config, project, "group"))
+        self.assertTrue(GetFeatureInfoFilter.query_form_popup(config, project, ""))
+
+        config = LizmapConfigView({"layers": {"lines": {"id": lines.id(), "popup": "True"}}}, 0.0)
+        self.assertFalse(GetFeatureInfoFilter.query_form_popup(config, project, "group"))
+
+    def test_fetch_features_get_feature_info(self):
+        """Test fetching the features of the GetFeatureInfo, by layer, with the attributes of the popup."""
+        layer = QgsVectorLayer("Point?field=name:string&field=description:string", "points", "memory")
+        features = []
+        for name in ("a", "b", "c"):
+            feature = QgsFeature(layer.fields())
+            feature.setAttributes([name, f"long text {name}"])
+            features.append(feature)
+        layer.dataProvider().addFeatures(features)
+        ids = [feature.id() for feature in layer.getFeatures()]
+
+        popup = '<p>[% "name" %]</p>'
+        results = [Result(layer, str(ids[0]), popup), Result(layer, str(ids[2]), popup)]
+        fetched = GetFeatureInfoFilter.fetch_features(results, False)
+        self.assertEqual(2, len(fetched))
+        self.assertEqual("a", fetched[(layer.id(), str(ids[0]))]["name"])
+        self.assertEqual("c", fetched[(layer.id(), str(ids[2]))]["name"])
+
+        template = expression_template('[% "name" %] [% attributes() %]')
+        self.assertIsNone(GetFeatureInfoFilter.required_attributes(layer, template))
+        template = expression_template('[% represent_value("description") %] [% $area %]')
+        self.assertListEqual([1], GetFeatureInfoFilter.required_attributes(layer, template))
+        self.assertTrue(template.needs_geometry())
+
+    def test_represent_values_get_feature_info(self):
+        """Test the represented values of a ValueRelation field, computed once by key."""
+        project = QgsProject.instance()
+        types = QgsVectorLayer("None?field=id:integer&field=label:string", "types", "memory")
+        for type_id, label in ((1, "One"), (2, "Two")):
+            feature = QgsFeature(types.fields())
+            feature.setAttributes([type_id, label])
+            types.dataProvider().addFeature(feature)
+        project.addMapLayer(types)
+
+        layer = QgsVectorLayer("Point?field=type:integer&field=other:integer", "points", "memory")
+        for index in (0, 1):
+            layer.setEditorWidgetSetup(
+                index,
+                QgsEditorWidgetSetup("ValueRelation", {"Layer": types.id(), "Key": "id", "Value": "label"}),
+            )
+        features = []
+        for type_id in (1, 2, 1, None):
+            feature = QgsFeature(layer.fields())
+            feature.setAttributes([type_id, type_id])
+            features.append(feature)
+
+        _represent_value_cache.clear()
+        try:
+            values = GetFeatureInfoFilter.represent_values(layer, features, {"type"})
+            self.assertDictEqual({("type", "1"): "One", ("type", "2"): "Two"}, values)
+            self.assertEqual(2, len(_represent_value_cache))
+
+            # From the cache, even if the label has been changed
+            types.dataProvider().changeAttributeValues({next(types.getFeatures()).id(): {1: "Changed"}})
+            self.assertDictEqual(values, GetFeatureInfoFilter.represent_values(layer, features, {"type"}))
+
+            # The represented values are used by the expressions
+            context = QgsExpressionContext()
+            context.appendScope(QgsExpressionContextUtils.layerScope(layer))
+            context.setFeature(features[0])
+            context.setFields(layer.fields())
+            context.setCachedValue(REPRESENT_VALUE_CONTEXT_KEY.format(layer.id(), "type", "1"), "Cached")
+            self.assertEqual("Cached", QgsExpression('represent_value("type")').evaluate(context))
+        finally:
+            _represent_value_cache.clear()
+            project.removeMapLayer(types.id())